@@ -15,3 +15,5 @@ import pbr.version
 
 
 __version__ = pbr.version.VersionInfo('django_openstack_auth').version_string()
+
+default_app_config = 'openstack_auth.apps.OpenstackAuthConfig'
@@ -0,0 +1,57 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+LOG = logging.getLogger(__name__)
+
+
+class OpenstackAuthConfig(AppConfig):
+    name = 'openstack_auth'
+    verbose_name = 'OpenStack Auth'
+
+    def ready(self):
+        if getattr(settings, 'OPENSTACK_AUTH_WARMUP', False):
+            warm_up()
+
+
+def warm_up():
+    """Loads on startup what the first request of a process would load.
+
+    The policy enforcers of all the services are loaded, in parallel
+    threads, the authentication plugins are imported and the pooled
+    Keystone session is created. Nothing is requested from Keystone. A
+    failing step is logged and does not prevent the startup.
+    """
+    from openstack_auth import backend
+    from openstack_auth import policy
+    from openstack_auth import utils
+
+    steps = (
+        ('policy enforcers', lambda: policy.preload(
+            getattr(settings, 'POLICY_PRELOAD_WORKERS', 4))),
+        ('authentication plugins',
+         lambda: backend.KeystoneBackend().auth_plugins),
+        ('Keystone session', utils.get_session),
+    )
+    for name, step in steps:
+        try:
+            step()
+        except Exception:
+            LOG.exception('Failed to load the %s on startup.' % name)
+        else:
+            LOG.debug('Loaded the %s on startup.' % name)
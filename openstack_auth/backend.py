@@ -13,6 +13,7 @@
 
 """ Module defining the Django auth backend class for the Keystone API. """
 
+from concurrent import futures
 import datetime
 import logging
 import pytz
@@ -22,8 +23,10 @@ from django.utils.module_loading import import_string  # noqa
 from django.utils.translation import ugettext_lazy as _
 
 from openstack_auth import exceptions
+from openstack_auth import policy
 from openstack_auth import user as auth_user
 from openstack_auth import utils
+from openstack_auth import vault
 
 
 LOG = logging.getLogger(__name__)
@@ -31,6 +34,11 @@ LOG = logging.getLogger(__name__)
 
 KEYSTONE_CLIENT_ATTR = "_keystoneclient"
 
+# Permission sets per (token id, services region), shared by all the users
+# built from the same session data in this process.
+_PERMISSIONS_CACHE = utils.LRUCache(
+    getattr(settings, 'OPENSTACK_PERMISSIONS_CACHE_SIZE', 1000))
+
 
 class KeystoneBackend(object):
     """Django authentication backend for use with ``django.contrib.auth``."""
@@ -74,11 +82,21 @@ class KeystoneBackend(object):
         if (hasattr(self, 'request') and
                 user_id == self.request.session["user_id"]):
             token = self.request.session['token']
+            if token is None:
+                # The token is gone from the token vault.
+                return None
             endpoint = self.request.session['region_endpoint']
+            if token.is_catalog_evicted:
+                # The catalog store is a cache, a catalog evicted from it
+                # is fetched again.
+                if not token.fetch_service_catalog(endpoint):
+                    return None
+                self.request.session.modified = True
             services_region = self.request.session['services_region']
-            user = auth_user.create_user_from_token(self.request, token,
-                                                    endpoint, services_region)
-            return user
+            # The full user is only built once something beyond the
+            # token and identity attributes is needed.
+            return auth_user.LazyUser(self.request, token, endpoint,
+                                      services_region)
         else:
             return None
 
@@ -122,10 +140,9 @@ class KeystoneBackend(object):
         self.check_auth_expiry(unscoped_auth_ref)
 
         domain_name = kwargs.get('user_domain_name', None)
-        domain_auth, domain_auth_ref = plugin.get_domain_scoped_auth(
-            unscoped_auth, unscoped_auth_ref, domain_name)
-        scoped_auth, scoped_auth_ref = plugin.get_project_scoped_auth(
-            unscoped_auth, unscoped_auth_ref, recent_project=recent_project)
+        (domain_auth, domain_auth_ref), (scoped_auth, scoped_auth_ref) = \
+            self._get_scoped_auths(plugin, unscoped_auth, unscoped_auth_ref,
+                                   domain_name, recent_project)
 
         # Abort if there are no projects for this user and a valid domain
         # token has not been obtained
@@ -156,15 +173,16 @@ class KeystoneBackend(object):
         # Check expiry for our new scoped token.
         self.check_auth_expiry(scoped_auth_ref)
 
+        unscoped_token = unscoped_auth_ref.auth_token
+        token = auth_user.Token(scoped_auth_ref, unscoped_token=unscoped_token)
+
         # We want to try to use the same region we just logged into
         # which may or may not be the default depending upon the order
         # keystone uses
         region_name = None
-        id_endpoints = scoped_auth_ref.service_catalog.\
-            get_endpoints(service_type='identity')
-        for id_endpoint in [cat for cat in id_endpoints['identity']]:
+        for id_endpoint in token.catalog_index.get_endpoints('identity'):
             if auth_url in id_endpoint.values():
-                region_name = id_endpoint['region']
+                region_name = utils.get_endpoint_region(id_endpoint)
                 break
 
         interface = getattr(settings, 'OPENSTACK_ENDPOINT_TYPE', 'public')
@@ -181,11 +199,9 @@ class KeystoneBackend(object):
                         "authentication.")
 
         # If we made it here we succeeded. Create our User!
-        unscoped_token = unscoped_auth_ref.auth_token
-
         user = auth_user.create_user_from_token(
             request,
-            auth_user.Token(scoped_auth_ref, unscoped_token=unscoped_token),
+            token,
             endpoint,
             services_region=region_name)
 
@@ -193,19 +209,35 @@ class KeystoneBackend(object):
             # if no k2k providers exist then the function returns quickly
             utils.store_initial_k2k_session(auth_url, request, scoped_auth_ref,
                                             unscoped_auth_ref)
-            request.session['unscoped_token'] = unscoped_token
+            utils.set_session_value(request.session, 'unscoped_token',
+                                    unscoped_token)
+            # Seed the scoped token cache used when switching projects.
+            utils.cache_scoped_auth_ref(request.session, unscoped_token,
+                                        scoped_auth_ref)
             if domain_auth_ref:
                 # check django session engine, if using cookies, this will not
                 # work, as it will overflow the cookie so don't add domain
-                # scoped token to the session and put error in the log
-                if utils.using_cookie_backed_sessions():
+                # scoped token to the session and put error in the log,
+                # unless a token vault keeps it out of the session.
+                if vault.get_vault() is not None:
+                    utils.set_session_value(
+                        request.session, 'domain_token',
+                        auth_user.VaultAccessInfo(domain_auth_ref))
+                    policy.set_domain_credentials(request.session,
+                                                  domain_auth_ref)
+                elif utils.using_cookie_backed_sessions():
                     LOG.error('Using signed cookies as SESSION_ENGINE with '
                               'OPENSTACK_KEYSTONE_MULTIDOMAIN_SUPPORT is '
                               'enabled. This disables the ability to '
                               'perform identity operations due to cookie size '
-                              'constraints.')
+                              'constraints. Configure OPENSTACK_TOKEN_VAULT '
+                              'to enable them.')
                 else:
-                    request.session['domain_token'] = domain_auth_ref
+                    utils.set_session_value(
+                        request.session, 'domain_token',
+                        auth_user.SessionAccessInfo(domain_auth_ref))
+                    policy.set_domain_credentials(request.session,
+                                                  domain_auth_ref)
 
             request.user = user
             timeout = getattr(settings, "SESSION_TIMEOUT", 3600)
@@ -224,6 +256,43 @@ class KeystoneBackend(object):
         LOG.debug('Authentication completed.')
         return user
 
+    def _get_scoped_auths(self, plugin, unscoped_auth, unscoped_auth_ref,
+                          domain_name, recent_project):
+        """Returns the domain and project scoped auth for the unscoped auth.
+
+        Both are derived from the unscoped token only, so when
+        ``OPENSTACK_KEYSTONE_CONCURRENT_SCOPING`` is enabled the domain is
+        scoped in a worker thread while the projects are scoped in the
+        calling thread.
+        """
+        concurrent = getattr(settings, 'OPENSTACK_KEYSTONE_CONCURRENT_SCOPING',
+                             False)
+        if not concurrent or utils.get_keystone_version() < 3:
+            domain_scoped = plugin.get_domain_scoped_auth(
+                unscoped_auth, unscoped_auth_ref, domain_name)
+            project_scoped = plugin.get_project_scoped_auth(
+                unscoped_auth, unscoped_auth_ref,
+                recent_project=recent_project)
+            return domain_scoped, project_scoped
+
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            domain_scoping = executor.submit(plugin.get_domain_scoped_auth,
+                                             unscoped_auth,
+                                             unscoped_auth_ref,
+                                             domain_name)
+            try:
+                project_scoped = plugin.get_project_scoped_auth(
+                    unscoped_auth, unscoped_auth_ref,
+                    recent_project=recent_project)
+            finally:
+                # Always join the domain scoping. An error raised there takes
+                # precedence, as it would when scoping sequentially.
+                domain_scoped = domain_scoping.result()
+        finally:
+            executor.shutdown(wait=False)
+        return domain_scoped, project_scoped
+
     def get_group_permissions(self, user, obj=None):
         """Returns an empty set since Keystone doesn't support "groups"."""
         # Keystone V3 added "groups". The Auth token response includes the
@@ -238,27 +307,38 @@ class KeystoneBackend(object):
         Keystone "roles".
 
         The permissions are returned as ``"openstack.{{ role.name }}"``.
+
+        The set is computed once per token and services region. It is
+        memoized on the user and in a per-process LRU cache holding
+        OPENSTACK_PERMISSIONS_CACHE_SIZE sets.
         """
         if user.is_anonymous() or obj is not None:
             return set()
+        key = (getattr(user.token, 'id', None), user.services_region)
+        memoized = getattr(user, '_permissions', None)
+        if memoized is not None and memoized[0] == key:
+            return memoized[1]
+
+        permissions = None
+        if key[0] is not None:
+            permissions = _PERMISSIONS_CACHE.get(key)
+        if permissions is None:
+            permissions = self._get_permissions(user)
+            if key[0] is not None:
+                _PERMISSIONS_CACHE.set(key, permissions)
+        user._permissions = (key, permissions)
+        return permissions
+
+    def _get_permissions(self, user):
         # TODO(gabrielhurley): Integrate policy-driven RBAC
         #                      when supported by Keystone.
         role_perms = {utils.get_role_permission(role['name'])
                       for role in user.roles}
 
-        services = []
-        for service in user.service_catalog:
-            try:
-                service_type = service['type']
-            except KeyError:
-                continue
-            service_regions = [utils.get_endpoint_region(endpoint) for endpoint
-                               in service.get('endpoints', [])]
-            if user.services_region in service_regions:
-                services.append(service_type.lower())
+        services = user.catalog_index.get_services(user.services_region)
         service_perms = {"openstack.services.%s" % service
                          for service in services}
-        return role_perms | service_perms
+        return frozenset(role_perms | service_perms)
 
     def has_perm(self, user, perm, obj=None):
         """Returns True if the given user has the specified permission."""
@@ -11,8 +11,10 @@
 # under the License.
 
 import abc
+from concurrent import futures
 import logging
 
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from keystoneauth1 import exceptions as keystone_exceptions
 from keystoneclient.v2_0 import client as v2_client
@@ -81,23 +83,36 @@ class BasePlugin(object):
         :returns: A list of projects. This currently accepts returning both v2
                   or v3 keystoneclient projects objects.
         """
+        if auth_ref is not None:
+            projects = utils.get_cached_project_list(
+                auth_ref.user_id, auth_ref.auth_token,
+                is_federated=auth_ref.is_federated)
+            if projects is not None:
+                return projects
+
         try:
             if self.keystone_version >= 3:
                 client = v3_client.Client(session=session, auth=auth_plugin)
                 if auth_ref.is_federated:
-                    return client.federation.projects.list()
+                    projects = client.federation.projects.list()
                 else:
-                    return client.projects.list(user=auth_ref.user_id)
+                    projects = client.projects.list(user=auth_ref.user_id)
 
             else:
                 client = v2_client.Client(session=session, auth=auth_plugin)
-                return client.tenants.list()
+                projects = client.tenants.list()
 
         except (keystone_exceptions.ClientException,
                 keystone_exceptions.AuthorizationFailure):
             msg = _('Unable to retrieve authorized projects.')
             raise exceptions.KeystoneAuthException(msg)
 
+        if auth_ref is not None:
+            utils.cache_project_list(projects, auth_ref.user_id,
+                                     auth_ref.auth_token, auth_ref.expires,
+                                     is_federated=auth_ref.is_federated)
+        return projects
+
     def list_domains(self, session, auth_plugin, auth_ref=None):
         try:
             if self.keystone_version >= 3:
@@ -170,10 +185,15 @@ class BasePlugin(object):
                     projects.insert(0, project)
                     break
 
+        token = unscoped_auth_ref.auth_token
+        workers = getattr(settings, 'OPENSTACK_PROJECT_SCOPE_WORKERS', 1)
+        if workers > 1 and len(projects) > 1:
+            return self._probe_project_scopes(session, auth_url, token,
+                                              projects, workers)
+
         scoped_auth = None
         scoped_auth_ref = None
         for project in projects:
-            token = unscoped_auth_ref.auth_token
             scoped_auth = utils.get_token_auth_plugin(auth_url,
                                                       token=token,
                                                       project_id=project.id)
@@ -189,6 +209,42 @@ class BasePlugin(object):
 
         return scoped_auth, scoped_auth_ref
 
+    def _probe_project_scopes(self, session, auth_url, token, projects,
+                              workers):
+        """Attempt to scope to the given projects concurrently.
+
+        Up to ``workers`` scoping requests are in flight at once. The result
+        is the first project, in the order given, that the token can be
+        scoped to; attempts that have not started yet are cancelled as soon
+        as the winner is known.
+        """
+        def scope(project):
+            scoped_auth = utils.get_token_auth_plugin(auth_url,
+                                                      token=token,
+                                                      project_id=project.id)
+            return scoped_auth, scoped_auth.get_access(session)
+
+        executor = futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(projects)))
+        attempts = []
+        try:
+            attempts = [executor.submit(scope, project)
+                        for project in projects]
+            for project, attempt in zip(projects, attempts):
+                try:
+                    return attempt.result()
+                except (keystone_exceptions.ClientException,
+                        keystone_exceptions.AuthorizationFailure):
+                    LOG.info('Attempted scope to project %s failed, will '
+                             'attempt to scope to another project.'
+                             % project.name)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            executor.shutdown(wait=False)
+
+        return None, None
+
     def get_domain_scoped_auth(self, unscoped_auth, unscoped_auth_ref,
                                domain_name=None):
         """Get the domain scoped keystone auth and access info
@@ -13,15 +13,20 @@
 
 """Policy engine for openstack_auth"""
 
+import ast
+from concurrent import futures
 import logging
 import os.path
+import threading
+import time
 
 from django.conf import settings
 from oslo_config import cfg
+from oslo_policy import _checks
 from oslo_policy import opts as policy_opts
 from oslo_policy import policy
+import six
 
-from openstack_auth import user as auth_user
 from openstack_auth import utils as auth_utils
 
 LOG = logging.getLogger(__name__)
@@ -29,6 +34,24 @@ LOG = logging.getLogger(__name__)
 _ENFORCER = None
 _BASE_PATH = getattr(settings, 'POLICY_FILES_PATH', '')
 
+# Policy decisions by scope, action, credentials and target, along with the
+# rules they were made with. The decisions only depend on the loaded rules,
+# so the cache is cleared whenever enforcers are reloaded, and decisions
+# made with other rules than the current ones are not used.
+_DECISIONS = auth_utils.LRUCache(
+    getattr(settings, 'POLICY_DECISION_CACHE_SIZE', 1000))
+
+# The modification time and size of the loaded policy files, by service.
+_POLICY_STAMPS = {}
+_NEXT_RELOAD_CHECK = 0
+_RELOAD_LOCK = threading.Lock()
+# Serializes the publishing of enforcers, not the checks using them.
+_LOAD_LOCK = threading.Lock()
+
+# The rules the predicates were compiled from, and the predicates of the
+# actions by name, by scope.
+_PREDICATES = {}
+
 
 def _get_policy_conf():
     conf = cfg.ConfigOpts()
@@ -44,28 +67,167 @@ def _get_policy_conf():
 
 
 def _get_enforcer():
+    """Returns the enforcers of all the services, loading them if needed.
+
+    The services without a policy file have no enforcer.
+    """
+    for service in getattr(settings, 'POLICY_FILES', {}):
+        _get_scope_enforcer(service)
+    return dict((service, enforcer)
+                for service, enforcer in (_ENFORCER or {}).items()
+                if enforcer is not None)
+
+
+def _get_scope_enforcer(scope):
+    """Returns the enforcer of a service, or ``None`` if it has no policy.
+
+    The policy file of a service is only loaded the first time the service
+    is checked.
+    """
+    _reload_changed_enforcers()
+    enforcers = _ENFORCER or {}
+    if scope in enforcers:
+        return enforcers[scope]
+    return _load_scope_enforcer(scope)
+
+
+def _load_scope_enforcer(scope):
     global _ENFORCER
-    if not _ENFORCER:
-        _ENFORCER = {}
+    policy_files = getattr(settings, 'POLICY_FILES', {})
+    if scope not in policy_files:
+        return None
+    policy_file = os.path.join(_BASE_PATH, policy_files[scope])
+    stamp = _get_file_stamp(policy_file)
+    # Policy files are parsed outside of the lock, so that the services
+    # can be loaded in parallel.
+    enforcer = _load_enforcer(_get_policy_conf(), scope, policy_file)
+    with _LOAD_LOCK:
+        enforcers = _ENFORCER or {}
+        if scope not in enforcers:
+            # Readers only ever see fully loaded enforcers.
+            enforcers = dict(enforcers)
+            enforcers[scope] = enforcer
+            _POLICY_STAMPS[scope] = stamp
+            _ENFORCER = enforcers
+        return enforcers[scope]
+
+
+def preload(workers=4):
+    """Loads the enforcers of all the services ahead of their first check.
+
+    :param workers: The number of policy files loaded in parallel.
+    :returns: The enforcers of all the services.
+    """
+    policy_files = getattr(settings, 'POLICY_FILES', {})
+    if policy_files:
+        executor = futures.ThreadPoolExecutor(
+            max_workers=max(1, min(workers, len(policy_files))))
+        try:
+            for loading in [executor.submit(_get_scope_enforcer, service)
+                            for service in policy_files]:
+                loading.result()
+        finally:
+            executor.shutdown(wait=True)
+    return _get_enforcer()
+
+
+def _load_enforcer(conf, service, policy_file):
+    enforcer = policy.Enforcer(conf, policy_file)
+    # Ensure enforcer.policy_path is populated.
+    enforcer.load_rules()
+    if getattr(settings, 'POLICY_RELOAD_INTERVAL', 0):
+        # Changed files are reloaded into a new enforcer, never into the
+        # rules being enforced.
+        enforcer.use_conf = False
+    if enforcer.policy_path and os.path.isfile(enforcer.policy_path):
+        LOG.debug("adding enforcer for service: %s" % service)
+        return enforcer
+    LOG.warning("policy file for service: %s not found at %s" %
+                (service, enforcer.policy_path or policy_file))
+    return None
+
+
+def _get_file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _reload_changed_enforcers():
+    """Reloads the enforcers of the policy files changed since loaded.
+
+    When POLICY_RELOAD_INTERVAL is set, the policy files are checked at
+    most once per interval, in seconds. The enforcer of a changed file is
+    fully loaded before it replaces the previous one, and the others are
+    kept. A check only happens in one thread at a time, the other threads
+    keep using the current enforcers instead of waiting for it. Only the
+    services already loaded are checked.
+    """
+    global _ENFORCER, _NEXT_RELOAD_CHECK
+    interval = getattr(settings, 'POLICY_RELOAD_INTERVAL', 0)
+    if not interval or time.time() < _NEXT_RELOAD_CHECK:
+        return
+    if not _RELOAD_LOCK.acquire(False):
+        return
+    try:
+        _NEXT_RELOAD_CHECK = time.time() + interval
+        reloaded = {}
+        stamps = {}
+        conf = None
         policy_files = getattr(settings, 'POLICY_FILES', {})
-        conf = _get_policy_conf()
-        for service in policy_files.keys():
+        for service in list(_ENFORCER or {}):
+            if service not in policy_files:
+                continue
             policy_file = os.path.join(_BASE_PATH, policy_files[service])
-            enforcer = policy.Enforcer(conf, policy_file)
-            # Ensure enforcer.policy_path is populated.
-            enforcer.load_rules()
-            if os.path.isfile(enforcer.policy_path):
-                LOG.debug("adding enforcer for service: %s" % service)
-                _ENFORCER[service] = enforcer
-            else:
-                LOG.warning("policy file for service: %s not found at %s" %
-                            (service, enforcer.policy_path))
-    return _ENFORCER
+            stamp = _get_file_stamp(policy_file)
+            if stamp == _POLICY_STAMPS.get(service):
+                continue
+            conf = conf or _get_policy_conf()
+            try:
+                reloaded[service] = _load_enforcer(conf, service,
+                                                   policy_file)
+            except Exception:
+                # Keep the previous rules, and try again next time.
+                LOG.exception("Failed to reload the policy file for "
+                              "service: %s" % service)
+                continue
+            LOG.info("reloaded policy file for service: %s" % service)
+            stamps[service] = stamp
+        if not reloaded:
+            return
+        with _LOAD_LOCK:
+            # Enforcers reset meanwhile are not brought back.
+            if _ENFORCER is None:
+                return
+            enforcers = dict(_ENFORCER)
+            enforcers.update(reloaded)
+            _POLICY_STAMPS.update(stamps)
+            _ENFORCER = enforcers
+            _clear_decisions()
+    finally:
+        _RELOAD_LOCK.release()
 
 
 def reset():
     global _ENFORCER
-    _ENFORCER = None
+    with _LOAD_LOCK:
+        _ENFORCER = None
+        _POLICY_STAMPS.clear()
+    _PREDICATES.clear()
+    _clear_decisions()
+
+
+def _clear_decisions():
+    _DECISIONS.clear()
+
+
+def decision_cache_info():
+    """Returns the hits, misses and size of the policy decision cache."""
+    return {'hits': _DECISIONS.hits,
+            'misses': _DECISIONS.misses,
+            'size': len(_DECISIONS)}
 
 
 def check(actions, request, target=None):
@@ -106,9 +268,81 @@ def check(actions, request, target=None):
                       {'project_id': object.project_id}
     :returns: boolean if the user has permission or not for the actions.
     """
+    user, credentials, domain_credentials = _get_credentials(request)
+    return _check_actions(actions, _normalize_target(target, user),
+                          credentials, domain_credentials)
+
+
+def check_targets(actions, request, targets):
+    """Check user permission for the same actions on many targets.
+
+    The credentials are computed once for all the targets, e.g. the rows of
+    a table.
+
+    :param actions: list of scope and action, see :func:`check`.
+    :param request: django http request object.
+    :param targets: list of targets, see :func:`check`. A target of
+        ``None`` is the default target.
+    :returns: list of booleans, the result of :func:`check` for each
+        target.
+    """
+    user, credentials, domain_credentials = _get_credentials(request)
+    return [_check_actions(actions, _normalize_target(target, user),
+                           credentials, domain_credentials)
+            for target in targets]
+
+
+def check_many(actions_list, request, target=None):
+    """Check user permission for many sets of actions on the same target.
+
+    The credentials are computed once for all the action sets, e.g. the
+    items of a menu.
+
+    :param actions_list: list of actions, see :func:`check`.
+    :param request: django http request object.
+    :param target: the target, see :func:`check`.
+    :returns: list of booleans, the result of :func:`check` for each set
+        of actions.
+    """
+    user, credentials, domain_credentials = _get_credentials(request)
+    target = _normalize_target(target, user)
+    return [_check_actions(actions, target, credentials, domain_credentials)
+            for actions in actions_list]
+
+
+def _get_credentials(request):
+    """Returns the user, and their project and domain credentials.
+
+    The credentials are returned along with their fingerprint, which is
+    computed once for all the checks made with them.
+    """
+    user = auth_utils.get_user(request)
+    credentials = _user_to_credentials(user)
+    domain_credentials = _domain_to_credentials(request, user)
+    # if there is a domain token use the domain_id instead of the user's domain
+    if domain_credentials:
+        credentials['domain_id'] = domain_credentials.get('domain_id')
+        domain_credentials = (domain_credentials,
+                              _fingerprint(domain_credentials))
+    return user, (credentials, _fingerprint(credentials)), domain_credentials
+
+
+def _fingerprint(credentials):
+    """Returns the hashable fingerprint of credentials, or ``None``.
+
+    The token is left out of the fingerprint, so users with the same roles
+    and ids share decisions.
+    """
+    try:
+        return _freeze({name: value for name, value in credentials.items()
+                        if name != 'token'})
+    except TypeError:
+        return None
+
+
+def _normalize_target(target, user):
     if target is None:
         target = {}
-    user = auth_utils.get_user(request)
 
     # Several service policy engines default to a project id check for
     # ownership. Since the user is already scoped to a project, if a
@@ -138,31 +372,34 @@ def check(actions, request, target=None):
     for key in domain_id_keys:
         if target.get(key) is None:
             target[key] = user.user_domain_id
+    return target
 
-    credentials = _user_to_credentials(user)
-    domain_credentials = _domain_to_credentials(request, user)
-    # if there is a domain token use the domain_id instead of the user's domain
-    if domain_credentials:
-        credentials['domain_id'] = domain_credentials.get('domain_id')
 
-    enforcer = _get_enforcer()
+def _check_actions(actions, target, credentials, domain_credentials):
+    """Checks the actions on a target.
 
+    The credentials are pairs of credentials and their fingerprint, as
+    returned by :func:`_get_credentials`.
+    """
+    try:
+        target_key = _freeze(target)
+    except TypeError:
+        target_key = None
     for action in actions:
         scope, action = action[0], action[1]
-        if scope in enforcer:
+        enforcer = _get_scope_enforcer(scope)
+        if enforcer is not None:
             # this is for handling the v3 policy file and will only be
             # needed when a domain scoped token is present
             if scope == 'identity' and domain_credentials:
                 # use domain credentials
-                if not _check_credentials(enforcer[scope],
-                                          action,
-                                          target,
-                                          domain_credentials):
+                if not _check_cached(scope, enforcer, action, target,
+                                     target_key, *domain_credentials):
                     return False
 
             # use project credentials
-            if not _check_credentials(enforcer[scope],
-                                      action, target, credentials):
+            if not _check_cached(scope, enforcer, action, target,
+                                 target_key, *credentials):
                 return False
 
         # if no policy for scope, allow action, underlying API will
@@ -171,22 +408,201 @@ def check(actions, request, target=None):
     return True
 
 
-def _check_credentials(enforcer_scope, action, target, credentials):
+def _freeze(value):
+    """Returns a hashable equivalent of a credentials or target value."""
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, _freeze(item))
+                                   for key, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    hash(value)
+    return value
+
+
+def _check_cached(scope, enforcer_scope, action, target, target_key,
+                  credentials, credentials_key):
+    """Checks the credentials, through the policy decision cache.
+
+    Targets or credentials holding values that cannot be fingerprinted,
+    whose key is ``None``, are checked without the cache.
+    """
+    if target_key is None or credentials_key is None:
+        return _check_credentials(scope, enforcer_scope, action, target,
+                                  credentials)
+    if enforcer_scope.use_conf:
+        # As Enforcer.enforce does, load the rules again when the policy
+        # file changed, before trusting a cached decision.
+        enforcer_scope.load_rules()
+    key = (scope, action, credentials_key, target_key)
+    rules = enforcer_scope.rules
+    entry = _DECISIONS.get(key)
+    # Decisions made with the previous rules of the service are stale.
+    if entry is None or entry[0] is not rules:
+        entry = (rules, _check_credentials(scope, enforcer_scope, action,
+                                           target, credentials))
+        _DECISIONS.set(key, entry)
+    return entry[1]
+
+
+def _check_credentials(scope, enforcer_scope, action, target, credentials):
     is_valid = True
-    if not enforcer_scope.enforce(action, target, credentials):
+    if not _enforce(scope, enforcer_scope, action, target, credentials):
         # to match service implementations, if a rule is not found,
         # use the default rule for that service policy
         #
         # waiting to make the check because the first call to
         # enforce loads the rules
         if action not in enforcer_scope.rules:
-            if not enforcer_scope.enforce('default', target, credentials):
+            if not _enforce(scope, enforcer_scope, 'default', target,
+                            credentials):
                 is_valid = False
         else:
             is_valid = False
     return is_valid
 
 
+def _enforce(scope, enforcer_scope, action, target, credentials):
+    """Enforces a rule, through its compiled predicate when there is one.
+
+    Set POLICY_COMPILE_RULES to False to always use ``Enforcer.enforce``.
+    """
+    if (getattr(settings, 'POLICY_COMPILE_RULES', True) and
+            isinstance(credentials, dict)):
+        if enforcer_scope.use_conf:
+            # As Enforcer.enforce does, load the rules again when the
+            # policy file changed.
+            enforcer_scope.load_rules()
+        predicate = _get_predicate(scope, enforcer_scope, action)
+        if predicate is not None:
+            return predicate(target, credentials)
+    return enforcer_scope.enforce(action, target, credentials)
+
+
+def _get_predicate(scope, enforcer_scope, action):
+    """Returns the compiled predicate of a rule, or ``None``.
+
+    Missing rules, which fall back to the default rule, and rules
+    registered in code, which may have scope types, are left to the
+    enforcer.
+    """
+    rules = enforcer_scope.rules
+    if (not rules or action not in rules or
+            action in getattr(enforcer_scope, 'registered_rules', {})):
+        return None
+    compiled_rules, predicates = _PREDICATES.get(scope, (None, None))
+    if compiled_rules is not rules:
+        predicates = {}
+        _PREDICATES[scope] = (rules, predicates)
+    if action not in predicates:
+        predicates[action] = _compile_check(rules, rules[action],
+                                            frozenset([action]))
+    return predicates[action]
+
+
+def _compile_check(rules, check, seen):
+    """Compiles an oslo.policy check into a ``predicate(target, creds)``.
+
+    The predicates give the same results as the checks for the role, rule,
+    generic (e.g. ``project_id:%(project_id)s``), boolean and constant
+    checks. Any other check is not compiled and ``None`` is returned.
+
+    :param rules: The rules the ``rule:`` checks refer to.
+    :param check: The check to compile.
+    :param seen: The names of the rules being compiled, to detect cycles.
+    """
+    check_type = type(check)
+    if check_type is _checks.TrueCheck:
+        return lambda target, creds: True
+    if check_type is _checks.FalseCheck:
+        return lambda target, creds: False
+    if check_type in (_checks.AndCheck, _checks.OrCheck):
+        predicates = [_compile_check(rules, rule, seen)
+                      for rule in check.rules]
+        if any(predicate is None for predicate in predicates):
+            return None
+        combine = all if check_type is _checks.AndCheck else any
+        return lambda target, creds: combine(
+            predicate(target, creds) for predicate in predicates)
+    if check_type is _checks.NotCheck:
+        predicate = _compile_check(rules, check.rule, seen)
+        if predicate is None:
+            return None
+        return lambda target, creds: not predicate(target, creds)
+    if check_type is _checks.RuleCheck:
+        if check.match in seen:
+            return None
+        try:
+            rule = rules[check.match]
+        except KeyError:
+            # We don't have any matching rule; fail closed
+            return lambda target, creds: False
+        return _compile_check(rules, rule, seen | frozenset([check.match]))
+    if check_type is _checks.RoleCheck:
+        return _compile_role_check(check.match)
+    if check_type is _checks.GenericCheck:
+        return _compile_generic_check(check.kind, check.match)
+    return None
+
+
+def _compile_role_check(match):
+    if '%' not in match:
+        role = match.lower()
+
+        def role_check(target, creds):
+            if 'roles' in creds:
+                return any(r.lower() == role for r in creds['roles'])
+            return False
+    else:
+        def role_check(target, creds):
+            try:
+                role = (match % target).lower()
+            except KeyError:
+                return False
+            if 'roles' in creds:
+                return any(r.lower() == role for r in creds['roles'])
+            return False
+    return role_check
+
+
+def _compile_generic_check(kind, match):
+    try:
+        # Try to interpret kind as a literal
+        value = six.text_type(ast.literal_eval(kind))
+    except ValueError:
+        path = kind.split('.')
+
+        def generic_check(target, creds):
+            try:
+                expected = match % target
+            except KeyError:
+                return False
+            return _find_in_dict(creds, path, expected)
+    except Exception:
+        return None
+    else:
+        def generic_check(target, creds):
+            try:
+                return match % target == value
+            except KeyError:
+                return False
+    return generic_check
+
+
+def _find_in_dict(test_value, path, match):
+    if not path:
+        return match == six.text_type(test_value)
+    try:
+        test_value = test_value[path[0]]
+    except KeyError:
+        return False
+    if isinstance(test_value, list):
+        return any(_find_in_dict(value, path[1:], match)
+                   for value in test_value)
+    return _find_in_dict(test_value, path[1:], match)
+
+
 def _user_to_credentials(user):
     if not hasattr(user, "_credentials"):
         roles = [role['name'] for role in user.roles]
@@ -205,20 +621,45 @@ def _user_to_credentials(user):
 def _domain_to_credentials(request, user):
     if not hasattr(user, "_domain_credentials"):
         try:
-            domain_auth_ref = request.session.get('domain_token')
-
-            # no domain role or not running on V3
-            if not domain_auth_ref:
-                return None
-            domain_user = auth_user.create_user_from_token(
-                request, auth_user.Token(domain_auth_ref),
-                domain_auth_ref.service_catalog.url_for(interface=None))
-            user._domain_credentials = _user_to_credentials(domain_user)
-
-            # uses the domain_id associated with the domain_user
-            user._domain_credentials['domain_id'] = domain_user.domain_id
+            credentials = request.session.get('domain_credentials')
+            if credentials is None:
+                # Sessions of users logged in before the domain credentials
+                # were kept in the session.
+                domain_auth_ref = request.session.get('domain_token')
+
+                # no domain role or not running on V3
+                if not domain_auth_ref:
+                    return None
+                credentials = set_domain_credentials(request.session,
+                                                     domain_auth_ref)
+            user._domain_credentials = dict(credentials)
 
         except Exception:
-            LOG.warning("Failed to create user from domain scoped token.")
+            LOG.warning("Failed to get credentials from domain scoped token.")
             return None
     return user._domain_credentials
+
+
+def set_domain_credentials(session, domain_auth_ref):
+    """Keeps the policy credentials of a domain scoped token in the session.
+
+    The credentials are a small dict, so the policy checks of the following
+    requests do not need the domain scoped token.
+
+    :param session: The session of the user.
+    :param domain_auth_ref: The domain scoped ``AccessInfo``.
+    :returns: The domain credentials.
+    """
+    roles = list(domain_auth_ref.role_names)
+    admin_roles = auth_utils.get_admin_roles()
+    credentials = {'user_id': domain_auth_ref.user_id,
+                   'username': domain_auth_ref.username,
+                   'project_id': domain_auth_ref.project_id,
+                   'tenant_id': domain_auth_ref.project_id,
+                   'project_name': domain_auth_ref.project_name,
+                   'domain_id': domain_auth_ref.domain_id,
+                   'is_admin': not admin_roles.isdisjoint(
+                       role.lower() for role in roles),
+                   'roles': roles}
+    auth_utils.set_session_value(session, 'domain_credentials', credentials)
+    return credentials
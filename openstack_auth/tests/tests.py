@@ -11,15 +11,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
 import uuid
 
 import django
 from django.conf import settings
 from django.contrib import auth
+from django.contrib.auth import models as auth_models
+from django.contrib.sessions.backends import cache as cache_session
+from django.core import exceptions as django_exceptions
+from django.core import signing
 from django.core.urlresolvers import reverse
 from django import http
 from django import test
 from django.test.utils import override_settings
+from django.utils import functional
+from django.utils import timezone
 from keystoneauth1 import exceptions as keystone_exceptions
 from keystoneauth1.identity import v2 as v2_auth
 from keystoneauth1.identity import v3 as v3_auth
@@ -29,13 +47,19 @@ from keystoneclient.v2_0 import client as client_v2
 from keystoneclient.v3 import client as client_v3
 import mock
 from mox3 import mox
+from oslo_policy import policy as oslo_policy
 from testscenarios import load_tests_apply_scenarios  # noqa
 
+from openstack_auth import apps
+from openstack_auth import backend
+from openstack_auth import exceptions
+from openstack_auth.plugin import password
 from openstack_auth import policy
 from openstack_auth.tests import data_v2
 from openstack_auth.tests import data_v3
 from openstack_auth import user
 from openstack_auth import utils
+from openstack_auth import vault
 
 
 DEFAULT_DOMAIN = settings.OPENSTACK_KEYSTONE_DEFAULT_DOMAIN
@@ -614,6 +638,36 @@ class OpenStackAuthTestsV3(OpenStackAuthTestsMixin,
         response = self.client.post(url, form_data)
         self.assertRedirects(response, settings.LOGIN_REDIRECT_URL)
 
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+        OPENSTACK_TOKEN_VAULT={
+            'BACKEND': 'openstack_auth.vault.LocalMemoryTokenVault'})
+    def test_login_with_token_vault(self):
+        projects = [self.data.project_one, self.data.project_two]
+        user = self.data.user
+        unscoped = self.data.unscoped_access_info
+
+        form_data = self.get_form_data(user)
+        self._mock_unscoped_and_domain_list_projects(user, projects)
+        self._mock_scoped_client_for_tenant(unscoped, self.data.project_one.id)
+
+        self.mox.ReplayAll()
+
+        url = reverse('login')
+        response = self.client.get(url, form_data)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, form_data)
+        self.assertRedirects(response, settings.LOGIN_REDIRECT_URL)
+
+        domain_token = self.client.session['domain_token']
+        self.assertEqual(self.data.domain_scoped_access_info.auth_token,
+                         domain_token.auth_token)
+        self.assertEqual(self.data.domain_scoped_access_info.domain_id,
+                         domain_token.domain_id)
+        domain_credentials = self.client.session['domain_credentials']
+        self.assertEqual(self.data.domain_scoped_access_info.domain_id,
+                         domain_credentials['domain_id'])
+
     def test_login_with_disabled_project(self):
         # Test to validate that authentication will not try to get
         # scoped token for disabled project.
@@ -787,6 +841,59 @@ class OpenStackAuthTestsV3(OpenStackAuthTestsMixin,
     def test_switch_with_next(self):
         self.test_switch(next='/next_url')
 
+    def test_switch_to_cached_project(self):
+        project = self.data.project_one
+        projects = [self.data.project_one, self.data.project_two]
+        user = self.data.user
+        scoped = self.data.scoped_access_info
+
+        form_data = self.get_form_data(user)
+
+        self._mock_unscoped_and_domain_list_projects(user, projects)
+        self._mock_scoped_client_for_tenant(scoped, project.id)
+
+        self.mox.ReplayAll()
+
+        url = reverse('login')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(url, form_data)
+        self.assertRedirects(response, settings.LOGIN_REDIRECT_URL)
+
+        # The scoped token obtained at login is reused without any call
+        # to Keystone.
+        url = reverse('switch_tenants', args=[project.id])
+        response = self.client.get(url, form_data)
+        self.assertRedirects(response, settings.LOGIN_REDIRECT_URL)
+
+        self.assertEqual(self.client.session['token'].project['id'],
+                         project.id)
+
+    def test_logout_purges_cached_tokens_and_projects(self):
+        user = self.data.user
+        unscoped = self.data.unscoped_access_info
+
+        self.test_switch_to_cached_project()
+        session = self.client.session
+        reference = session['scoped_tokens'][self.data.project_one.id][2]
+        self.assertIsNotNone(vault.CacheTokenVault().load(reference))
+        self.assertIsNotNone(utils.get_cached_project_list(
+            user.id, unscoped.auth_token))
+
+        response = self.client.get(reverse('logout'))
+        self.assertEqual(302, response.status_code)
+
+        self.assertNotIn('scoped_tokens', self.client.session)
+        self.assertIsNone(vault.CacheTokenVault().load(reference))
+        self.assertIsNone(utils.get_cached_project_list(
+            user.id, unscoped.auth_token))
+
+    @override_settings(OPENSTACK_SCOPED_TOKEN_CACHE_TIMEOUT=0)
+    def test_switch_without_scoped_token_cache(self):
+        self.test_switch()
+
     def test_switch_region(self, next=None):
         projects = [self.data.project_one, self.data.project_two]
         user = self.data.user
@@ -856,10 +963,7 @@ class OpenStackAuthTestsV3(OpenStackAuthTestsMixin,
         plugin.get_access(mox.IsA(session.Session)
                           ).AndReturn(self.data.unscoped_access_info)
         plugin.auth_url = auth_url
-        client = self.ks_client_module.Client(session=mox.IsA(session.Session),
-                                              auth=plugin)
-
-        self._mock_unscoped_list_projects(client, user, projects)
+        # The project list of the base token is served from the cache.
         plugin = self._create_token_auth(
             self.data.project_one.id,
             token=self.data.unscoped_access_info.auth_token,
@@ -923,10 +1027,7 @@ class OpenStackAuthTestsV3(OpenStackAuthTestsMixin,
             self.data.unscoped_access_info)
 
         plugin.auth_url = auth_url
-        client = self.ks_client_module.Client(session=mox.IsA(session.Session),
-                                              auth=plugin)
-
-        self._mock_unscoped_list_projects(client, user, projects)
+        # The project list of the base token is served from the cache.
         plugin = self._create_token_auth(
             self.data.project_one.id,
             token=self.data.unscoped_access_info.auth_token,
@@ -1003,9 +1104,7 @@ class OpenStackAuthTestsV3(OpenStackAuthTestsMixin,
         client = self._mock_unscoped_token_client(None, auth_url=auth_url,
                                                   plugin=unscoped_auth)
         self._mock_unscoped_list_domains(client, domains)
-        client = self._mock_unscoped_token_client(None, auth_url=auth_url,
-                                                  plugin=unscoped_auth)
-        self._mock_unscoped_list_projects(client, user, projects)
+        # The project list of the base token is served from the cache.
         self._mock_scoped_client_for_tenant(unscoped, self.data.project_one.id)
 
         self.mox.ReplayAll()
@@ -1244,6 +1343,58 @@ class PolicyLoaderTestCase(test.TestCase):
         policy.reset()
         self.assertIsNone(policy._ENFORCER)
 
+    def test_policy_files_loaded_on_first_use(self):
+        policy.reset()
+        self.addCleanup(policy.reset)
+        compute = policy._get_scope_enforcer('compute')
+        self.assertEqual(['compute'], list(policy._ENFORCER))
+        self.assertIs(compute, policy._get_scope_enforcer('compute'))
+        self.assertIsNone(policy._get_scope_enforcer('dummy'))
+        self.assertEqual(['compute'], list(policy._ENFORCER))
+
+    @override_settings(POLICY_FILES={'identity': 'keystone_policy.json',
+                                     'volume': 'missing_policy.json'})
+    def test_missing_policy_file_loaded_once(self):
+        policy.reset()
+        self.addCleanup(policy.reset)
+        with mock.patch.object(policy, '_load_enforcer',
+                               wraps=policy._load_enforcer) as load:
+            self.assertIsNone(policy._get_scope_enforcer('volume'))
+            self.assertIsNone(policy._get_scope_enforcer('volume'))
+        self.assertEqual(1, load.call_count)
+        self.assertEqual(['identity'], list(policy._get_enforcer()))
+
+
+class WarmUpTestCase(test.TestCase):
+    def setUp(self):
+        super(WarmUpTestCase, self).setUp()
+        policy.reset()
+        self.addCleanup(policy.reset)
+
+    def test_preload_policy_enforcers(self):
+        enforcers = policy.preload(workers=2)
+        self.assertEqual(set(['identity', 'compute']), set(enforcers))
+        self.assertEqual(enforcers, policy._get_enforcer())
+
+    @override_settings(OPENSTACK_AUTH_WARMUP=False)
+    def test_warm_up_disabled(self):
+        with mock.patch.object(apps, 'warm_up') as warm_up:
+            django.apps.apps.get_app_config('openstack_auth').ready()
+        self.assertFalse(warm_up.called)
+
+    @override_settings(OPENSTACK_AUTH_WARMUP=True)
+    def test_warm_up_on_ready(self):
+        with mock.patch.object(apps, 'warm_up') as warm_up:
+            django.apps.apps.get_app_config('openstack_auth').ready()
+        warm_up.assert_called_once_with()
+
+    @override_settings(AUTHENTICATION_PLUGINS=['openstack_auth.missing'])
+    def test_warm_up(self):
+        with mock.patch.object(utils, 'get_session') as get_session:
+            apps.warm_up()
+        self.assertEqual(2, len(policy._ENFORCER))
+        get_session.assert_called_once_with()
+
 
 class PermTestCase(test.TestCase):
     def test_has_perms(self):
@@ -1265,6 +1416,28 @@ class PermTestCase(test.TestCase):
             perm_list = ['perm1', ('perm2', 'perm3')]
             self.assertTrue(testuser.has_perms(perm_list))
 
+    def test_permission_checker(self):
+        testuser = user.User(id=1, roles=[], enabled=True)
+        checks = [
+            ([], True),
+            (['perm2'], False),
+            (['perm1', 'perm2'], False),
+            (['perm1', 'perm3'], True),
+            (['perm1', ('perm2', 'perm3')], True),
+            (['perm1', ('perm2', 'perm4')], False),
+            ([('perm1',), ()], True),
+        ]
+        with mock.patch.object(testuser, 'get_all_permissions',
+                               return_value={'perm1', 'perm3'}):
+            for perm_list, expected in checks:
+                checker = user.PermissionChecker(perm_list)
+                self.assertEqual(expected, checker(testuser))
+                self.assertEqual(expected, testuser.has_perms(checker))
+
+            testuser.enabled = False
+            self.assertFalse(user.PermissionChecker(['perm1'])(testuser))
+            self.assertTrue(user.PermissionChecker([])(testuser))
+
 
 class PolicyTestCase(test.TestCase):
     _roles = []
@@ -1346,6 +1519,316 @@ class PolicyTestCaseAdmin(PolicyTestCase):
         self.assertTrue(value)
 
 
+class PolicyDecisionCacheTestCase(PolicyTestCase):
+    _roles = [{'id': '1', 'name': 'member'}]
+
+    def setUp(self):
+        super(PolicyDecisionCacheTestCase, self).setUp()
+        policy.reset()
+        self.addCleanup(policy.reset)
+
+    def _check(self, action, target=None):
+        return policy.check((("identity", action),), request=self.request,
+                            target=target)
+
+    def test_decisions_are_cached(self):
+        with mock.patch.object(policy, '_enforce',
+                               wraps=policy._enforce) as enforce:
+            self.assertFalse(self._check("admin_required"))
+            self.assertFalse(self._check("admin_required"))
+            self.assertEqual(1, enforce.call_count)
+            self.assertFalse(self._check("admin_required",
+                                         {'project_id': 'other'}))
+            self.assertEqual(2, enforce.call_count)
+        self.assertEqual({'hits': 1, 'misses': 2, 'size': 2},
+                         policy.decision_cache_info())
+
+    def test_reset_clears_decisions(self):
+        self._check("admin_required")
+        policy.reset()
+        self.assertEqual(0, policy.decision_cache_info()['size'])
+
+    def test_reloaded_rules_invalidate_decisions(self):
+        self.assertFalse(self._check("admin_required"))
+        enforcer = policy._get_enforcer()['identity']
+        rules = dict(enforcer.rules)
+        rules.update(oslo_policy.Rules.from_dict({'admin_required': '@'}))
+        enforcer.rules = oslo_policy.Rules(rules)
+        self.assertTrue(self._check("admin_required"))
+
+    def test_credentials_fingerprinted_once(self):
+        targets = [{'project_id': 'p%d' % i} for i in range(3)]
+        with mock.patch.object(policy, '_fingerprint',
+                               wraps=policy._fingerprint) as fingerprint:
+            self.assertEqual([False] * 3, policy.check_targets(
+                (("identity", "admin_required"),), self.request, targets))
+        self.assertEqual(1, fingerprint.call_count)
+        self.assertEqual(3, policy.decision_cache_info()['size'])
+
+    def test_unhashable_target(self):
+        target = {'project_id': None, 'tags': [{'name': object}],
+                  'owner': mock.Mock(__hash__=None)}
+        self.assertFalse(self._check("admin_required", target))
+        self.assertEqual(0, policy.decision_cache_info()['size'])
+
+
+class PolicyBatchTestCase(PolicyTestCase):
+    _roles = [{'id': '1', 'name': 'member'}]
+
+    def setUp(self):
+        super(PolicyBatchTestCase, self).setUp()
+        policy.reset()
+
+    def test_check_targets(self):
+        targets = [{'project_id': 'p%d' % i} for i in range(3)] + [None]
+        with mock.patch.object(policy, '_user_to_credentials',
+                               wraps=policy._user_to_credentials) as creds:
+            results = policy.check_targets(
+                (("compute", "compute:get_all"),), self.request, targets)
+        self.assertEqual([True] * 4, results)
+        self.assertEqual(1, creds.call_count)
+        self.assertEqual('p2', targets[2]['tenant_id'])
+        self.assertEqual([False, False], policy.check_targets(
+            (("identity", "admin_required"),), self.request, [{}, None]))
+
+    def test_check_many(self):
+        actions_list = [(("identity", "admin_required"),),
+                        (("compute", "compute:get_all"),),
+                        (("dummy", "default"),),
+                        (("compute", "compute:get_all"),
+                         ("identity", "admin_required"))]
+        self.assertEqual(
+            [policy.check(actions, self.request) for actions in actions_list],
+            policy.check_many(actions_list, self.request))
+        self.assertEqual([False, True, True, False],
+                         policy.check_many(actions_list, self.request))
+
+
+def _policy_credentials(**kwargs):
+    credentials = {'user_id': 'u1', 'username': 'user', 'project_id': 'p1',
+                   'tenant_id': 'p1', 'project_name': 'project',
+                   'domain_id': 'd1', 'is_admin': False, 'roles': []}
+    credentials.update(kwargs)
+    return credentials
+
+
+class PolicyCompiledRulesTestCase(test.TestCase):
+    policy_files = sorted(
+        name for name in os.listdir(settings.POLICY_FILES_PATH)
+        if name.endswith('.json'))
+
+    credentials = [
+        _policy_credentials(),
+        _policy_credentials(roles=['member']),
+        _policy_credentials(roles=['Member']),
+        _policy_credentials(roles=['admin'], is_admin=True),
+        _policy_credentials(roles=['ADMIN', 'member'], is_admin=True),
+        _policy_credentials(roles=['service']),
+        _policy_credentials(roles=['admin'], domain_id=None),
+        _policy_credentials(roles=['admin'], project_id=None,
+                            tenant_id=None, is_admin=True),
+        _policy_credentials(user_id='u2', roles=['member']),
+        {'user_id': 'u1', 'project_id': 'p1'},
+    ]
+
+    def setUp(self):
+        super(PolicyCompiledRulesTestCase, self).setUp()
+        policy.reset()
+        self.addCleanup(policy.reset)
+
+    def _get_enforcer(self, policy_file):
+        path = os.path.join(settings.POLICY_FILES_PATH, policy_file)
+        return policy._load_enforcer(policy._get_policy_conf(), policy_file,
+                                     path)
+
+    def _get_targets(self, policy_file):
+        path = os.path.join(settings.POLICY_FILES_PATH, policy_file)
+        with open(path) as f:
+            keys = set(re.findall(r'%\((.+?)\)s', f.read()))
+
+        def value(key, match):
+            for suffix, value in (('user_id', 'u1'), ('domain_id', 'd1'),
+                                  ('domain.id', 'd1'), ('project_id', 'p1'),
+                                  ('project.id', 'p1')):
+                if key.endswith(suffix):
+                    return value if match else 'other'
+            return 'other'
+
+        targets = [{}, {'project_id': 'p1'}, {'project_id': 'p2'},
+                   dict((key, value(key, True)) for key in keys),
+                   dict((key, value(key, False)) for key in keys)]
+        return targets + [dict((key, v) for key in keys)
+                          for v in ('u1', 'd1', 'p1')]
+
+    def test_all_rules_compiled(self):
+        for policy_file in self.policy_files:
+            enforcer = self._get_enforcer(policy_file)
+            for action in enforcer.rules:
+                self.assertIsNotNone(policy._get_predicate(
+                    policy_file, enforcer, action), (policy_file, action))
+
+    def test_compiled_rules_match_enforcer(self):
+        for policy_file in self.policy_files:
+            enforcer = self._get_enforcer(policy_file)
+            actions = list(enforcer.rules) + ['i_dont_exist']
+            for action, target, credentials in itertools.product(
+                    actions, self._get_targets(policy_file),
+                    self.credentials):
+                self.assertEqual(
+                    bool(enforcer.enforce(action, target, credentials)),
+                    bool(policy._enforce(policy_file, enforcer, action,
+                                         target, credentials)),
+                    (policy_file, action, target, credentials))
+
+    def test_uncompiled_rules_use_enforcer(self):
+        enforcer = self._get_enforcer('keystone_policy.json')
+        enforcer.set_rules(oslo_policy.Rules.from_dict({
+            'remote': 'http://example.com/check',
+            'loop': 'rule:loop or role:admin',
+            'mixed': 'role:admin or rule:remote',
+            'admin': 'role:admin'}), use_conf=False)
+        for action in ('remote', 'loop', 'mixed'):
+            self.assertIsNone(policy._get_predicate('identity', enforcer,
+                                                    action))
+        self.assertIsNotNone(policy._get_predicate('identity', enforcer,
+                                                   'admin'))
+        credentials = _policy_credentials()
+        with mock.patch.object(enforcer, 'enforce',
+                               return_value=True) as enforce:
+            self.assertTrue(policy._enforce('identity', enforcer, 'mixed',
+                                            {}, credentials))
+        enforce.assert_called_once_with('mixed', {}, credentials)
+
+    @override_settings(POLICY_COMPILE_RULES=False)
+    def test_compiled_rules_disabled(self):
+        enforcer = self._get_enforcer('keystone_policy.json')
+        with mock.patch.object(enforcer, 'enforce',
+                               return_value=True) as enforce:
+            self.assertTrue(policy._enforce('identity', enforcer,
+                                            'admin_required', {},
+                                            _policy_credentials()))
+        self.assertEqual(1, enforce.call_count)
+
+
+class DomainCredentialsTestCase(PolicyTestCase):
+    def setUp(self):
+        super(DomainCredentialsTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        self.request.session = cache_session.SessionStore()
+        self.domain_auth_ref = self.data.domain_scoped_access_info
+
+    def test_matches_domain_user_credentials(self):
+        self.request.session['domain_token'] = self.domain_auth_ref
+        credentials = policy._domain_to_credentials(
+            self.request, utils.get_user(self.request))
+        domain_user = user.create_user_from_token(
+            self.request, user.Token(self.domain_auth_ref),
+            self.domain_auth_ref.service_catalog.url_for(interface=None))
+        expected = policy._user_to_credentials(domain_user)
+        expected['domain_id'] = domain_user.domain_id
+        del expected['token']
+        self.assertEqual(expected, credentials)
+        self.assertEqual(credentials,
+                         self.request.session['domain_credentials'])
+
+    def test_domain_user_not_rebuilt(self):
+        policy.set_domain_credentials(self.request.session,
+                                      self.domain_auth_ref)
+        with mock.patch.object(user, 'create_user_from_token') as create:
+            credentials = policy._domain_to_credentials(
+                self.request, utils.get_user(self.request))
+        self.assertFalse(create.called)
+        self.assertEqual(self.domain_auth_ref.domain_id,
+                         credentials['domain_id'])
+        self.assertNotIn('domain_token', self.request.session)
+
+    def test_no_domain_token(self):
+        self.assertIsNone(policy._domain_to_credentials(
+            self.request, utils.get_user(self.request)))
+        self.assertNotIn('domain_credentials', self.request.session)
+
+
+@override_settings(POLICY_RELOAD_INTERVAL=60,
+                   POLICY_FILES={'identity': 'keystone_policy.json',
+                                 'compute': 'nova_policy.json'})
+class PolicyReloadTestCase(PolicyTestCase):
+    _roles = [{'id': '1', 'name': 'member'}]
+
+    def setUp(self):
+        super(PolicyReloadTestCase, self).setUp()
+        self.policy_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.policy_dir)
+        for name in ('keystone_policy.json', 'nova_policy.json'):
+            shutil.copy(os.path.join(settings.POLICY_FILES_PATH, name),
+                        self.policy_dir)
+        patcher = mock.patch.object(policy, '_BASE_PATH', self.policy_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        policy.reset()
+        self.addCleanup(policy.reset)
+
+    def _check(self, action):
+        return policy.check((("identity", action),), request=self.request)
+
+    def _rewrite_keystone_policy(self, rules):
+        path = os.path.join(self.policy_dir, 'keystone_policy.json')
+        with open(path, 'w') as f:
+            f.write(rules)
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        policy._NEXT_RELOAD_CHECK = 0
+
+    def test_changed_policy_file_is_reloaded(self):
+        enforcers = policy._get_enforcer()
+        self.assertFalse(self._check("admin_required"))
+        self._rewrite_keystone_policy('{"admin_required": "role:member"}')
+        reloaded = policy._get_enforcer()
+        self.assertIsNot(enforcers['identity'], reloaded['identity'])
+        self.assertIs(enforcers['compute'], reloaded['compute'])
+        self.assertEqual(0, policy.decision_cache_info()['size'])
+        self.assertTrue(self._check("admin_required"))
+
+    def test_unchanged_policy_files_are_kept(self):
+        enforcers = policy._get_enforcer()
+        policy._NEXT_RELOAD_CHECK = 0
+        self.assertEqual(enforcers, policy._get_enforcer())
+
+    def test_files_checked_once_per_interval(self):
+        enforcers = policy._get_enforcer()
+        policy._NEXT_RELOAD_CHECK = 0
+        policy._get_enforcer()
+        self._rewrite_keystone_policy('{"admin_required": "role:member"}')
+        policy._NEXT_RELOAD_CHECK = time.time() + 60
+        self.assertEqual(enforcers, policy._get_enforcer())
+
+    @override_settings(POLICY_RELOAD_INTERVAL=0)
+    def test_reload_disabled(self):
+        enforcers = policy._get_enforcer()
+        self._rewrite_keystone_policy('{"admin_required": "role:member"}')
+        self.assertEqual(enforcers, policy._get_enforcer())
+
+    @override_settings(POLICY_RELOAD_INTERVAL=0)
+    def test_edited_policy_changes_cached_decision(self):
+        self.assertFalse(self._check("admin_required"))
+        self.assertFalse(self._check("admin_required"))
+        self.assertEqual(1, policy.decision_cache_info()['hits'])
+        self._rewrite_keystone_policy('{"admin_required": "role:member"}')
+        self.assertTrue(self._check("admin_required"))
+
+    def test_invalid_policy_file_keeps_rules(self):
+        enforcers = policy._get_enforcer()
+        self._rewrite_keystone_policy('{"admin_required": ')
+        self.assertEqual(enforcers, policy._get_enforcer())
+        self.assertFalse(self._check("admin_required"))
+
+    def test_readers_do_not_wait_for_reload(self):
+        enforcers = policy._get_enforcer()
+        self._rewrite_keystone_policy('{"admin_required": "role:member"}')
+        with policy._RELOAD_LOCK:
+            self.assertEqual(enforcers, policy._get_enforcer())
+        self.assertNotEqual(enforcers, policy._get_enforcer())
+
+
 class PolicyTestCaseV3Admin(PolicyTestCase):
     _roles = [{'id': '1', 'name': 'admin'}]
 
@@ -1407,6 +1890,39 @@ class RoleTestCaseAdmin(test.TestCase):
 
 class UtilsTestCase(test.TestCase):
 
+    def test_is_token_valid(self):
+        data = data_v3.generate_test_data()
+        token = user.Token(data.scoped_access_info)
+        expires = timezone.now() + datetime.timedelta(seconds=100)
+        naive = timezone.make_naive(expires, timezone.utc)
+        for value in (expires, naive):
+            token.expires = value
+            self.assertAlmostEqual(
+                (expires - timezone.now()).total_seconds(),
+                token.expires_epoch - time.time(), places=1)
+            self.assertTrue(utils.is_token_valid(token))
+            self.assertTrue(utils.is_token_valid(token, margin=90))
+            self.assertFalse(utils.is_token_valid(token, margin=110))
+            with self.settings(TOKEN_TIMEOUT_MARGIN=110):
+                self.assertFalse(utils.is_token_valid(token))
+        auth_ref = mock.Mock(spec=['expires'], expires=naive)
+        self.assertTrue(utils.is_token_valid(auth_ref))
+        self.assertFalse(utils.is_token_valid(auth_ref, margin=110))
+        token.expires = None
+        self.assertFalse(utils.is_token_valid(token))
+
+    def test_legacy_token_expires_epoch(self):
+        data = data_v3.generate_test_data()
+        token = user.Token(data.scoped_access_info)
+        state = token.__dict__.copy()
+        state['serviceCatalog'] = state.pop('_service_catalog')
+        state['expires'] = state.pop('_expires')
+        del state['expires_epoch']
+        legacy = user.Token.__new__(user.Token)
+        legacy.__setstate__(state)
+        self.assertEqual(token.expires, legacy.expires)
+        self.assertEqual(token.expires_epoch, legacy.expires_epoch)
+
     def test_fix_auth_url_version_v20(self):
         settings.OPENSTACK_API_VERSIONS['identity'] = 2.0
         test_urls = [
@@ -1442,6 +1958,952 @@ class UtilsTestCase(test.TestCase):
         for src, expected in test_urls:
             self.assertEqual(expected, utils.fix_auth_url_version_prefix(src))
 
+    def test_get_session_is_shared(self):
+        utils.reset_session()
+        self.addCleanup(utils.reset_session)
+        sess = utils.get_session()
+        self.assertIsInstance(sess, session.Session)
+        self.assertIs(sess, utils.get_session())
+
+    @override_settings(OPENSTACK_SESSION_POOL_SIZE=3,
+                       OPENSTACK_SESSION_KEEPALIVE=False)
+    def test_get_session_pool_settings(self):
+        utils.reset_session()
+        self.addCleanup(utils.reset_session)
+        requests_session = utils.get_session().session
+        adapter = requests_session.get_adapter('https://localhost:5000/v3')
+        self.assertEqual(3, adapter._pool_maxsize)
+        self.assertEqual('close', requests_session.headers['Connection'])
+
+
+@override_settings(OPENSTACK_PROJECT_SCOPE_WORKERS=4)
+class ConcurrentProjectScopeTestCase(test.TestCase):
+
+    def setUp(self):
+        super(ConcurrentProjectScopeTestCase, self).setUp()
+        settings.OPENSTACK_API_VERSIONS['identity'] = 3
+        self.data = data_v3.generate_test_data()
+        self.plugin = password.PasswordPlugin()
+        self.unscoped_auth = mock.Mock(
+            auth_url=settings.OPENSTACK_KEYSTONE_URL)
+        self.projects = [mock.Mock(id=uuid.uuid4().hex, enabled=True)
+                         for i in range(3)]
+        patcher = mock.patch.object(self.plugin, 'list_projects',
+                                    return_value=self.projects)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _mock_scoping(self, failing):
+        def get_token_auth_plugin(auth_url, token, project_id):
+            scoped_auth = mock.Mock(project_id=project_id)
+            if project_id in failing:
+                scoped_auth.get_access.side_effect = (
+                    keystone_exceptions.AuthorizationFailure)
+            else:
+                scoped_auth.get_access.return_value = project_id
+            return scoped_auth
+
+        patcher = mock.patch.object(utils, 'get_token_auth_plugin',
+                                    side_effect=get_token_auth_plugin)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_successful_project_wins(self):
+        self._mock_scoping(failing=[self.projects[0].id])
+        scoped_auth, scoped_auth_ref = self.plugin.get_project_scoped_auth(
+            self.unscoped_auth, self.data.unscoped_access_info)
+        self.assertEqual(self.projects[1].id, scoped_auth_ref)
+        self.assertEqual(self.projects[1].id, scoped_auth.project_id)
+
+    def test_recent_project_wins(self):
+        self._mock_scoping(failing=[])
+        recent_project = self.projects[2].id
+        scoped_auth, scoped_auth_ref = self.plugin.get_project_scoped_auth(
+            self.unscoped_auth, self.data.unscoped_access_info,
+            recent_project=recent_project)
+        self.assertEqual(recent_project, scoped_auth_ref)
+
+    def test_no_project_can_be_scoped(self):
+        self._mock_scoping(failing=[p.id for p in self.projects])
+        scoped_auth, scoped_auth_ref = self.plugin.get_project_scoped_auth(
+            self.unscoped_auth, self.data.unscoped_access_info)
+        self.assertIsNone(scoped_auth_ref)
+
+
+@override_settings(OPENSTACK_KEYSTONE_CONCURRENT_SCOPING=True)
+class ConcurrentScopingTestCase(test.TestCase):
+
+    def setUp(self):
+        super(ConcurrentScopingTestCase, self).setUp()
+        settings.OPENSTACK_API_VERSIONS['identity'] = 3
+        self.backend = backend.KeystoneBackend()
+        self.plugin = mock.Mock()
+
+    def test_domain_and_project_scoped_concurrently(self):
+        project_scoping = threading.Event()
+
+        def get_domain_scoped_auth(*args):
+            # Only completes if project scoping runs at the same time.
+            if project_scoping.wait(5):
+                return 'domain_auth', 'domain_auth_ref'
+            return None, None
+
+        def get_project_scoped_auth(*args, **kwargs):
+            project_scoping.set()
+            return 'scoped_auth', 'scoped_auth_ref'
+
+        self.plugin.get_domain_scoped_auth.side_effect = get_domain_scoped_auth
+        self.plugin.get_project_scoped_auth.side_effect = (
+            get_project_scoped_auth)
+
+        domain_scoped, project_scoped = self.backend._get_scoped_auths(
+            self.plugin, 'unscoped_auth', 'unscoped_auth_ref', 'domain',
+            'recent_project')
+        self.assertEqual(('domain_auth', 'domain_auth_ref'), domain_scoped)
+        self.assertEqual(('scoped_auth', 'scoped_auth_ref'), project_scoped)
+        self.plugin.get_project_scoped_auth.assert_called_once_with(
+            'unscoped_auth', 'unscoped_auth_ref',
+            recent_project='recent_project')
+
+    def test_domain_scoping_error_takes_precedence(self):
+        self.plugin.get_domain_scoped_auth.side_effect = (
+            exceptions.KeystoneAuthException('domain'))
+        self.plugin.get_project_scoped_auth.side_effect = (
+            exceptions.KeystoneAuthException('project'))
+
+        with self.assertRaisesRegexp(exceptions.KeystoneAuthException,
+                                     'domain'):
+            self.backend._get_scoped_auths(
+                self.plugin, 'unscoped_auth', 'unscoped_auth_ref', 'domain',
+                None)
+
+
+class ProjectListCacheTestCase(test.TestCase):
+
+    def setUp(self):
+        super(ProjectListCacheTestCase, self).setUp()
+        settings.OPENSTACK_API_VERSIONS['identity'] = 3
+        self.data = data_v3.generate_test_data()
+        self.user_id = self.data.user.id
+        self.token = self.data.unscoped_access_info.auth_token
+        self.expires = self.data.unscoped_access_info.expires
+        self.projects = [self.data.project_one, self.data.project_two]
+
+    def test_cache_project_list(self):
+        self.assertIsNone(
+            utils.get_cached_project_list(self.user_id, self.token))
+        utils.cache_project_list(self.projects, self.user_id, self.token,
+                                 self.expires)
+        projects = utils.get_cached_project_list(self.user_id, self.token)
+        self.assertEqual([p.to_dict() for p in self.projects],
+                         [p.to_dict() for p in projects])
+        self.assertIsNone(utils.get_cached_project_list(
+            self.user_id, self.token, is_federated=True))
+
+    def test_expired_token_is_not_cached(self):
+        expires = timezone.now() - datetime.timedelta(seconds=1)
+        utils.cache_project_list(self.projects, self.user_id, self.token,
+                                 expires)
+        self.assertIsNone(
+            utils.get_cached_project_list(self.user_id, self.token))
+
+    @override_settings(OPENSTACK_PROJECT_LIST_CACHE_TIMEOUT=0)
+    def test_cache_disabled(self):
+        utils.cache_project_list(self.projects, self.user_id, self.token,
+                                 self.expires)
+        self.assertIsNone(
+            utils.get_cached_project_list(self.user_id, self.token))
+
+    def test_get_project_list_uses_cache(self):
+        utils.cache_project_list(self.projects, self.user_id, self.token,
+                                 self.expires)
+        with mock.patch.object(utils, 'get_keystone_client') as client:
+            projects = utils.get_project_list(
+                user_id=self.user_id,
+                auth_url=settings.OPENSTACK_KEYSTONE_URL,
+                token=self.token)
+        self.assertFalse(client.called)
+        self.assertEqual([self.data.project_one.id,
+                          self.data.project_two.id],
+                         [project.id for project in projects])
+
+
+class ScopedTokenCacheTestCase(test.TestCase):
+
+    def setUp(self):
+        super(ScopedTokenCacheTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        self.unscoped_token = self.data.unscoped_access_info.auth_token
+        self.scoped = self.data.scoped_access_info
+        self.session = {}
+
+    def test_cache_scoped_auth_ref(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        auth_ref = utils.get_cached_scoped_auth_ref(
+            self.session, self.unscoped_token, self.scoped.project_id)
+        self.assertEqual(self.scoped.auth_token, auth_ref.auth_token)
+        self.assertIsNone(utils.get_cached_scoped_auth_ref(
+            self.session, self.unscoped_token, self.data.project_two.id))
+
+    def test_cache_is_per_session(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        self.assertIsNone(utils.get_cached_scoped_auth_ref(
+            {}, self.unscoped_token, self.scoped.project_id))
+        # Nor is it returned for another unscoped token.
+        self.assertIsNone(utils.get_cached_scoped_auth_ref(
+            self.session, 'another_token', self.scoped.project_id))
+
+    def test_domain_scoped_auth_ref_is_not_cached(self):
+        domain_scoped = self.data.domain_scoped_access_info
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    domain_scoped)
+        self.assertEqual({}, self.session)
+
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    def test_not_cached_in_cookie_sessions(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        self.assertEqual({}, self.session)
+
+    def test_token_timeout_margin(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        # The test tokens expire in one day.
+        with self.settings(TOKEN_TIMEOUT_MARGIN=2 * 24 * 3600):
+            self.assertIsNone(utils.get_cached_scoped_auth_ref(
+                self.session, self.unscoped_token, self.scoped.project_id))
+
+    def test_cache_timeout(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        with mock.patch.object(utils.time, 'time',
+                               return_value=time.time() + 3601):
+            self.assertIsNone(utils.get_cached_scoped_auth_ref(
+                self.session, self.unscoped_token, self.scoped.project_id))
+
+    @override_settings(OPENSTACK_SCOPED_TOKEN_CACHE_SIZE=1)
+    def test_cache_size(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        evicted = self.session['scoped_tokens'][self.scoped.project_id][2]
+        other = copy.deepcopy(self.scoped)
+        other._project['id'] = self.data.project_two.id
+        with mock.patch.object(utils.time, 'time',
+                               return_value=time.time() + 1):
+            utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                        other)
+        self.assertEqual([self.data.project_two.id],
+                         list(self.session['scoped_tokens']))
+        self.assertIsNone(vault.CacheTokenVault().load(evicted))
+
+    def test_session_only_holds_references(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        self.assertLess(len(pickle.dumps(self.session['scoped_tokens'])),
+                        len(utils.encode_access_info(self.scoped)) // 2)
+
+    @override_settings(OPENSTACK_TOKEN_VAULT={
+        'BACKEND': 'openstack_auth.vault.LocalMemoryTokenVault'})
+    def test_cached_in_token_vault(self):
+        utils.cache_scoped_auth_ref(self.session, self.unscoped_token,
+                                    self.scoped)
+        reference = self.session['scoped_tokens'][self.scoped.project_id][2]
+        self.assertIsNotNone(vault.get_vault().load(reference))
+        utils.remove_cached_scoped_auth_refs(self.session)
+        self.assertIsNone(vault.get_vault().load(reference))
+        self.assertEqual({}, self.session)
+
+
+class ServiceCatalogIndexTestCase(test.TestCase):
+
+    def test_v3_catalog(self):
+        data = data_v3.generate_test_data()
+        token = user.Token(data.scoped_access_info)
+        index = token.catalog_index
+        self.assertIs(index, token.catalog_index)
+        self.assertEqual(['RegionOne', 'RegionTwo'], index.regions)
+        self.assertEqual(['RegionOne', 'RegionTwo'], index.all_regions)
+        self.assertEqual({'identity', 'compute'},
+                         index.get_services('RegionOne'))
+        self.assertEqual({'compute'}, index.get_services('RegionTwo'))
+        self.assertEqual(frozenset(), index.get_services('RegionThree'))
+        self.assertEqual(3, len(index.get_endpoints('identity')))
+        endpoints = index.get_endpoints('compute', interface='public',
+                                        region='RegionTwo')
+        self.assertEqual(['http://nova2-public.localhost:8774/v2.0/%s'
+                          % data.project_one.id],
+                         [endpoint['url'] for endpoint in endpoints])
+        self.assertEqual(endpoints, index.get_endpoints(
+            'compute', interface='publicURL', region='RegionTwo'))
+
+    def test_v2_catalog(self):
+        data = data_v2.generate_test_data()
+        index = user.Token(data.scoped_access_info).catalog_index
+        self.assertEqual(['RegionOne', 'RegionTwo'], index.regions)
+        self.assertEqual(1, len(index.get_endpoints('compute',
+                                                    interface='adminURL',
+                                                    region='RegionTwo')))
+
+    @override_settings(OPENSTACK_CATALOG_ALLOWLIST={'compute': ['public']})
+    def test_catalog_allowlist_v3(self):
+        data = data_v3.generate_test_data()
+        token = user.Token(data.scoped_access_info)
+        index = token.catalog_index
+        self.assertEqual({'identity', 'compute'},
+                         {service['type'] for service in token.serviceCatalog})
+        self.assertEqual(3, len(index.get_endpoints('identity')))
+        self.assertEqual({'public'}, {endpoint['interface'] for endpoint
+                                      in index.get_endpoints('compute')})
+        self.assertEqual(6, len(data.scoped_access_info.service_catalog.
+                                catalog[1]['endpoints']))
+        with self.settings(OPENSTACK_CATALOG_ALLOWLIST={
+                'identity': ['admin'], 'volume': None}):
+            catalog = user.Token(data.scoped_access_info).serviceCatalog
+        self.assertEqual(['identity'],
+                         [service['type'] for service in catalog])
+        self.assertEqual({'admin'}, {endpoint['interface'] for endpoint
+                                     in catalog[0]['endpoints']})
+
+    @override_settings(OPENSTACK_CATALOG_ALLOWLIST={'compute': ['publicURL'],
+                                                    'identity': None})
+    def test_catalog_allowlist_v2(self):
+        data = data_v2.generate_test_data()
+        index = user.Token(data.scoped_access_info).catalog_index
+        endpoints = index.get_endpoints('compute')
+        self.assertEqual(2, len(endpoints))
+        for endpoint in endpoints:
+            self.assertIn('publicURL', endpoint)
+            self.assertNotIn('adminURL', endpoint)
+            self.assertNotIn('internalURL', endpoint)
+        self.assertIn('adminURL', index.get_endpoints('identity')[0])
+
+    def test_catalog_index_is_not_pickled(self):
+        data = data_v3.generate_test_data()
+        token = user.Token(data.scoped_access_info)
+        token.catalog_index
+        self.assertNotIn('_catalog_index', token.__getstate__())
+
+    def test_user_shares_token_catalog_index(self):
+        data = data_v3.generate_test_data()
+        token = user.Token(data.scoped_access_info)
+        testuser = user.User(id=1, token=token,
+                             service_catalog=token.serviceCatalog)
+        self.assertIs(token.catalog_index, testuser.catalog_index)
+        self.assertEqual(['RegionOne', 'RegionTwo'],
+                         testuser.available_services_regions)
+
+    def test_default_services_region(self):
+        catalog = [{'type': 'identity',
+                    'endpoints': [{'region': 'RegionOne'}]}]
+        self.assertEqual('RegionOne', utils.default_services_region(catalog))
+        self.assertIsNone(utils.default_services_region([]))
+        request = http.HttpRequest()
+        request.COOKIES['services_region'] = 'RegionTwo'
+        catalog.append({'type': 'compute',
+                        'endpoints': [{'region': 'RegionTwo'}]})
+        self.assertEqual('RegionTwo',
+                         utils.default_services_region(catalog, request))
+
+
+class PermissionsCacheTestCase(test.TestCase):
+
+    def setUp(self):
+        super(PermissionsCacheTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        self.token = user.Token(self.data.scoped_access_info)
+        self.backend = backend.KeystoneBackend()
+        backend._PERMISSIONS_CACHE.clear()
+        self.addCleanup(backend._PERMISSIONS_CACHE.clear)
+
+    def _create_user(self):
+        return user.User(id=self.token.user['id'], token=self.token,
+                         service_catalog=self.token.serviceCatalog,
+                         roles=self.token.roles, services_region='RegionOne',
+                         enabled=True)
+
+    def test_permissions_are_memoized(self):
+        testuser = self._create_user()
+        get_permissions = backend.KeystoneBackend._get_permissions
+        with mock.patch.object(backend.KeystoneBackend, '_get_permissions',
+                               autospec=True,
+                               side_effect=get_permissions) as get:
+            self.assertTrue(testuser.has_perms(
+                ['openstack.roles.member', 'openstack.services.compute',
+                 'openstack.services.identity']))
+            self.assertFalse(self.backend.has_perm(
+                testuser, 'openstack.roles.admin'))
+            # A user rebuilt from the same token shares the cached set.
+            self.assertTrue(self.backend.has_perm(
+                self._create_user(), 'openstack.services.identity'))
+        self.assertEqual(1, get.call_count)
+
+    def test_switching_region_invalidates_permissions(self):
+        testuser = self._create_user()
+        self.assertIn('openstack.services.identity',
+                      self.backend.get_all_permissions(testuser))
+        testuser.services_region = 'RegionTwo'
+        permissions = self.backend.get_all_permissions(testuser)
+        self.assertNotIn('openstack.services.identity', permissions)
+        self.assertIn('openstack.services.compute', permissions)
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual((3, 1), (cache.hits, cache.misses))
+
+
+class SessionDataTestCase(test.TestCase):
+
+    def setUp(self):
+        super(SessionDataTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+
+    def test_token_round_trip(self):
+        token = user.Token(self.data.scoped_access_info,
+                           unscoped_token=self.data.unscoped_access_info.
+                           auth_token)
+        catalog = token.serviceCatalog
+        token.catalog_index
+        loaded = pickle.loads(pickle.dumps(token))
+        self.assertNotIn('_service_catalog', loaded.__dict__)
+        self.assertNotIn('_catalog_index', loaded.__dict__)
+        self.assertEqual(token.id, loaded.id)
+        self.assertEqual(token.expires, loaded.expires)
+        self.assertEqual(token.project, loaded.project)
+        self.assertIs(loaded.project, loaded.tenant)
+        self.assertEqual(token.roles, loaded.roles)
+        # Saving a loaded token again reuses its encoded catalog.
+        self.assertEqual(loaded.__getstate__()['_encoded_catalog'],
+                         loaded.__dict__['_encoded_catalog'])
+        self.assertEqual(catalog, loaded.serviceCatalog)
+        self.assertEqual(['RegionOne', 'RegionTwo'],
+                         loaded.catalog_index.regions)
+
+    def test_token_pickled_by_earlier_release(self):
+        token = user.Token(self.data.scoped_access_info)
+        state = token.__dict__.copy()
+        state['serviceCatalog'] = state.pop('_service_catalog')
+        legacy = user.Token.__new__(user.Token)
+        legacy.__setstate__(state)
+        self.assertEqual(token.id, legacy.id)
+        self.assertEqual(token.serviceCatalog, legacy.serviceCatalog)
+        loaded = pickle.loads(pickle.dumps(legacy))
+        self.assertEqual(token.serviceCatalog, loaded.serviceCatalog)
+
+    def test_token_records(self):
+        token = user.Token(self.data.scoped_access_info)
+        project = token.project
+        self.assertEqual(self.data.project_one.id, project['id'])
+        self.assertEqual(self.data.project_one.name, project.get('name'))
+        self.assertIsNone(project.get('missing'))
+        self.assertRaises(KeyError, lambda: project['missing'])
+        self.assertEqual({'id', 'name', 'is_admin_project', 'domain_id'},
+                         set(project))
+        self.assertIs(dict, type(project))
+        self.assertEqual(['Member'], [role['name'] for role in token.roles])
+        self.assertEqual([{'name': 'Member'}], token.roles)
+        project['name'] = 'renamed'
+        self.assertEqual('renamed', token.tenant['name'])
+        loaded = pickle.loads(pickle.dumps(token))
+        self.assertIs(loaded.project, loaded.tenant)
+        self.assertEqual(token.project, loaded.project)
+        self.assertEqual(token.roles, loaded.roles)
+
+    def test_user_roles_json_serializable(self):
+        token = user.Token(self.data.scoped_access_info)
+        request = http.HttpRequest()
+        request.session = {}
+        auth_user = user.create_user_from_token(request, token,
+                                                'http://localhost:5000/v3')
+        self.assertEqual('[{"name": "Member"}]', json.dumps(auth_user.roles))
+        json.dumps(auth_user.token.project)
+        json.dumps(auth_user.token.user)
+
+    def test_token_with_dicts_pickled_by_earlier_release(self):
+        token = user.Token(self.data.scoped_access_info)
+        state = token.__dict__.copy()
+        state['serviceCatalog'] = state.pop('_service_catalog')
+        state['user'] = dict(token.user)
+        state['project'] = state['tenant'] = dict(token.project)
+        state['domain'] = dict(token.domain)
+        state['roles'] = [{'name': 'member'}, {'id': '1', 'name': 'admin'}]
+        legacy = user.Token.__new__(user.Token)
+        legacy.__setstate__(state)
+        self.assertEqual(token.user, legacy.user)
+        self.assertIs(legacy.project, legacy.tenant)
+        self.assertEqual({'name': 'member'}, legacy.roles[0])
+        self.assertEqual({'id': '1', 'name': 'admin'}, legacy.roles[1])
+        loaded = pickle.loads(pickle.dumps(legacy))
+        self.assertEqual(token.project, loaded.project)
+        self.assertEqual(legacy.roles, loaded.roles)
+
+    def test_session_access_info(self):
+        auth_ref = self.data.domain_scoped_access_info
+        domain_token = user.SessionAccessInfo(auth_ref)
+        self.assertEqual(auth_ref.auth_token, domain_token.auth_token)
+        loaded = pickle.loads(pickle.dumps(domain_token))
+        self.assertIs(functional.empty, loaded._wrapped)
+        self.assertEqual(auth_ref.auth_token, loaded.auth_token)
+        self.assertEqual(auth_ref.domain_id, loaded.domain_id)
+        self.assertEqual(auth_ref.expires, loaded.expires)
+        self.assertEqual(auth_ref.role_names, loaded.role_names)
+        self.assertEqual(auth_ref.service_catalog.catalog,
+                         loaded.service_catalog.catalog)
+        self.assertLess(len(pickle.dumps(domain_token)),
+                        len(pickle.dumps(auth_ref)))
+
+
+@override_settings(OPENSTACK_CATALOG_STORE_ENABLED=True)
+class CatalogStoreTestCase(test.TestCase):
+
+    def setUp(self):
+        super(CatalogStoreTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        utils.get_cache().clear()
+        utils._CATALOG_CACHE.clear()
+        self.addCleanup(utils._CATALOG_CACHE.clear)
+
+    def test_catalog_is_referenced_by_hash(self):
+        token = user.Token(self.data.scoped_access_info)
+        catalog = token.serviceCatalog
+        other = user.Token(self.data.scoped_access_info)
+        self.assertEqual(token._catalog_hash, other._catalog_hash)
+
+        state = token.__getstate__()
+        self.assertNotIn('_service_catalog', state)
+        self.assertNotIn('_encoded_catalog', state)
+
+        loaded = pickle.loads(pickle.dumps(token))
+        self.assertEqual(catalog, loaded.serviceCatalog)
+        # Rehydrated from the shared cache when not in the process LRU.
+        utils._CATALOG_CACHE.clear()
+        loaded = pickle.loads(pickle.dumps(token))
+        self.assertEqual(catalog, loaded.serviceCatalog)
+        self.assertIs(loaded.serviceCatalog,
+                      pickle.loads(pickle.dumps(token)).serviceCatalog)
+
+    @override_settings(OPENSTACK_CATALOG_ALLOWLIST={'image': None})
+    def test_same_catalog_in_every_process(self):
+        catalog = self.data.scoped_access_info.service_catalog.catalog
+        catalog_hash = utils.store_catalog(
+            catalog, self.data.scoped_access_info.expires)
+        warm = utils.load_catalog(catalog_hash)
+        utils._CATALOG_CACHE.clear()
+        cold = utils.load_catalog(catalog_hash)
+        self.assertEqual(warm, cold)
+        self.assertEqual(['identity'], [service['type'] for service in cold])
+
+    def _get_user(self, token):
+        request = http.HttpRequest()
+        request.session = cache_session.SessionStore()
+        request.session.update({'user_id': token.user['id'],
+                                'token': token,
+                                'region_endpoint':
+                                    settings.OPENSTACK_KEYSTONE_URL,
+                                'services_region': 'RegionOne'})
+        keystone_backend = backend.KeystoneBackend()
+        keystone_backend.request = request
+        return keystone_backend.get_user(token.user['id']), request
+
+    def _evicted_token(self):
+        token = pickle.loads(pickle.dumps(
+            user.Token(self.data.scoped_access_info)))
+        utils.get_cache().clear()
+        utils._CATALOG_CACHE.clear()
+        return token
+
+    @override_settings(OPENSTACK_API_VERSIONS={'identity': 3})
+    def test_evicted_catalog_is_fetched_again(self):
+        catalog = self.data.scoped_access_info.service_catalog.catalog
+        token = self._evicted_token()
+        self.assertTrue(token.is_catalog_evicted)
+        self.assertTrue(utils.is_token_valid(token))
+
+        with mock.patch.object(utils, 'get_session') as get_session:
+            get_session.return_value.get.return_value.json.return_value = {
+                'catalog': catalog}
+            lazy_user, request = self._get_user(token)
+        get_session.return_value.get.assert_called_once_with(
+            'http://localhost:5000/v3/auth/catalog',
+            headers={'X-Auth-Token': token.id}, authenticated=False)
+        self.assertIsNotNone(lazy_user)
+        self.assertTrue(request.session.modified)
+        self.assertFalse(token.is_catalog_evicted)
+        self.assertEqual(utils.filter_catalog(catalog), token.serviceCatalog)
+        self.assertTrue(utils.has_stored_catalog(token._catalog_hash))
+
+    def test_evicted_catalog_fetch_failure(self):
+        token = self._evicted_token()
+        with mock.patch.object(utils, 'fetch_catalog',
+                               side_effect=keystone_exceptions.Unauthorized):
+            self.assertIsNone(self._get_user(token)[0])
+
+    def test_catalog_is_not_decoded_to_check_it(self):
+        token = pickle.loads(pickle.dumps(
+            user.Token(self.data.scoped_access_info)))
+        utils._CATALOG_CACHE.clear()
+        with override_settings(OPENSTACK_CATALOG_STORE_ENABLED=False):
+            session_token = pickle.loads(pickle.dumps(
+                user.Token(self.data.scoped_access_info)))
+        with mock.patch.object(utils, 'decode_session_data') as decode:
+            for checked in (token, session_token):
+                self.assertFalse(checked.is_catalog_evicted)
+                self.assertTrue(utils.is_token_valid(checked))
+                self.assertIsNotNone(self._get_user(checked)[0])
+        self.assertFalse(decode.called)
+
+    def test_catalog_is_written_once(self):
+        auth_ref = self.data.scoped_access_info
+        with mock.patch.object(utils.get_cache(), 'set',
+                               wraps=utils.get_cache().set) as cache_set:
+            user.Token(auth_ref)
+            user.Token(auth_ref)
+        self.assertEqual(1, cache_set.call_count)
+        self.assertEqual(utils.get_token_life(auth_ref.expires),
+                         cache_set.call_args[0][2])
+
+    @override_settings(SESSION_TIMEOUT=1800)
+    def test_catalog_without_expiration(self):
+        catalog = self.data.scoped_access_info.service_catalog.catalog
+        with mock.patch.object(utils.get_cache(), 'set') as cache_set:
+            utils.store_catalog(catalog, None)
+        self.assertEqual(1800, cache_set.call_args[0][2])
+
+    def test_replaced_catalog_is_stored_in_session(self):
+        token = user.Token(self.data.scoped_access_info)
+        token.serviceCatalog = []
+        self.assertNotIn('_catalog_hash', token.__getstate__())
+        self.assertEqual([], pickle.loads(pickle.dumps(token)).serviceCatalog)
+
+    @override_settings(OPENSTACK_CATALOG_STORE_ENABLED=False)
+    def test_disabled(self):
+        token = user.Token(self.data.scoped_access_info)
+        self.assertNotIn('_catalog_hash', token.__dict__)
+        self.assertIn('_encoded_catalog', token.__getstate__())
+
+
+class TokenVaultTestCase(test.TestCase):
+
+    def setUp(self):
+        super(TokenVaultTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        utils.get_cache().clear()
+
+    def _test_vault(self, token_vault):
+        reference = token_vault.store(b'data', 60)
+        self.assertLess(len(reference), 100)
+        self.assertEqual(b'data', token_vault.load(reference))
+        self.assertIsNone(token_vault.load(reference + 'x'))
+        token_vault.delete(reference)
+        self.assertIsNone(token_vault.load(reference))
+        reference = token_vault.store(b'data', 0)
+        self.assertIsNone(token_vault.load(reference))
+
+    def test_cache_vault(self):
+        self._test_vault(vault.CacheTokenVault())
+
+    def test_local_memory_vault(self):
+        self._test_vault(vault.LocalMemoryTokenVault())
+
+    def test_file_vault(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self._test_vault(vault.FileTokenVault(PATH=path))
+
+    def test_file_vault_path(self):
+        self.assertRaises(django_exceptions.ImproperlyConfigured,
+                          vault.FileTokenVault)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        token_vault = vault.FileTokenVault(PATH=os.path.join(path, 'vault'))
+        reference = token_vault.store(b'data', 60)
+        self.assertEqual(0o700, os.stat(token_vault.path).st_mode & 0o777)
+        os.chmod(token_vault.path, 0o755)
+        self.assertRaises(django_exceptions.ImproperlyConfigured,
+                          token_vault.load, reference)
+        self.assertRaises(django_exceptions.ImproperlyConfigured,
+                          token_vault.store, b'data', 60)
+
+    def test_file_vault_sweeps_expired_files(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        token_vault = vault.FileTokenVault(PATH=path, SWEEP_INTERVAL=60)
+        token_vault.store(b'expired', 10)
+        kept = token_vault.store(b'kept', 3600)
+        self.assertEqual(2, len(os.listdir(path)))
+        # Not swept again within the interval.
+        with mock.patch.object(vault.time, 'time',
+                               return_value=time.time() + 30):
+            token_vault.store(b'data', 3600)
+        self.assertEqual(3, len(os.listdir(path)))
+        with mock.patch.object(vault.time, 'time',
+                               return_value=time.time() + 90):
+            token_vault.store(b'data', 3600)
+        self.assertEqual(3, len(os.listdir(path)))
+        self.assertEqual(b'kept', token_vault.load(kept))
+
+    def test_tampered_data_is_not_loaded(self):
+        token_vault = vault.LocalMemoryTokenVault()
+        reference = token_vault.store(b'data', 60)
+        key = signing.loads(reference, salt=vault._SALT)
+        expires, signed = token_vault._data[key]
+        token_vault._data[key] = (expires, signed[:-4] + b'evil')
+        self.assertIsNone(token_vault.load(reference))
+
+    @override_settings(OPENSTACK_TOKEN_VAULT={
+        'BACKEND': 'openstack_auth.vault.LocalMemoryTokenVault'})
+    def test_vault_access_info(self):
+        auth_ref = self.data.domain_scoped_access_info
+        domain_token = user.VaultAccessInfo(auth_ref)
+        self.assertEqual(auth_ref.auth_token, domain_token.auth_token)
+        pickled = pickle.dumps(domain_token)
+        self.assertLess(len(pickled), 300)
+        loaded = pickle.loads(pickled)
+        self.assertTrue(loaded)
+        self.assertEqual(auth_ref.domain_id, loaded.domain_id)
+        self.assertEqual(auth_ref.role_names, loaded.role_names)
+        domain_token.delete()
+        self.assertFalse(pickle.loads(pickled))
+
+    def test_get_vault(self):
+        self.assertIsNone(vault.get_vault())
+        config = {'BACKEND': 'openstack_auth.vault.FileTokenVault',
+                  'OPTIONS': {'PATH': '/tmp/vault'}}
+        with override_settings(OPENSTACK_TOKEN_VAULT=config):
+            token_vault = vault.get_vault()
+            self.assertIsInstance(token_vault, vault.FileTokenVault)
+            self.assertEqual('/tmp/vault', token_vault.path)
+            self.assertIs(token_vault, vault.get_vault())
+
+
+class SessionWritesTestCase(test.TestCase):
+
+    def setUp(self):
+        super(SessionWritesTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        self.token = user.Token(self.data.scoped_access_info)
+        self.request = http.HttpRequest()
+        self.request.session = cache_session.SessionStore()
+        utils.get_cache().clear()
+
+    def _create_user(self, token=None, services_region='RegionOne'):
+        token = token or self.token
+        return user.create_user_from_token(self.request, token,
+                                           settings.OPENSTACK_KEYSTONE_URL,
+                                           services_region)
+
+    def test_set_session_value(self):
+        session = self.request.session
+        self.assertTrue(utils.set_session_value(session, 'key', 'value'))
+        session.modified = False
+        self.assertFalse(utils.set_session_value(session, 'key', 'value'))
+        self.assertFalse(session.modified)
+        self.assertTrue(utils.set_session_value(session, 'key', 'other'))
+        self.assertTrue(session.modified)
+
+    def test_unchanged_user_is_not_written(self):
+        testuser = self._create_user()
+        user.set_session_from_user(self.request, testuser)
+        self.assertTrue(self.request.session.modified)
+        self.request.session.modified = False
+        user.set_session_from_user(self.request, testuser)
+        self.assertFalse(self.request.session.modified)
+        testuser.services_region = 'RegionTwo'
+        user.set_session_from_user(self.request, testuser)
+        self.assertTrue(self.request.session.modified)
+        self.assertEqual('RegionTwo', self.request.session['services_region'])
+
+    @override_settings(
+        OPENSTACK_TOKEN_VAULT={
+            'BACKEND': 'openstack_auth.vault.CacheTokenVault'},
+        OPENSTACK_TOKEN_VAULT_SESSION_TOKEN=True)
+    def test_token_in_vault(self):
+        user.set_session_from_user(self.request, self._create_user())
+        reference = self.token._vault_reference
+        self.assertLess(len(pickle.dumps(self.token)), 300)
+        loaded = pickle.loads(pickle.dumps(self.request.session['token']))
+        self.assertEqual(self.token.id, loaded.id)
+        self.assertEqual(self.token.serviceCatalog, loaded.serviceCatalog)
+        self.assertEqual(reference, loaded._vault_reference)
+        self.assertEqual(self.token.expires, loaded.expires)
+        self.assertEqual(self.token.project, loaded.project)
+        self.assertEqual(self.token.roles, loaded.roles)
+
+        # A region switch does not store the token again.
+        testuser = self._create_user(loaded, 'RegionTwo')
+        self.request.session['token'] = loaded
+        user.set_session_from_user(self.request, testuser)
+        self.assertEqual(reference, loaded._vault_reference)
+
+        # A new token replaces the previous one in the vault.
+        token = user.Token(self.data.scoped_access_info)
+        user.set_session_from_user(self.request, self._create_user(token))
+        self.assertNotEqual(reference, token._vault_reference)
+        self.assertIsNone(pickle.loads(pickle.dumps(loaded)))
+
+        self.request.session['user_id'] = self.token.user['id']
+        self.request.session[auth.SESSION_KEY] = self.token.user['id']
+        self.request.session[auth.BACKEND_SESSION_KEY] = \
+            'openstack_auth.backend.KeystoneBackend'
+        self.request.session['token'] = None
+        self.assertIsInstance(utils.get_user(self.request),
+                              auth_models.AnonymousUser)
+
+    @override_settings(
+        OPENSTACK_TOKEN_VAULT={
+            'BACKEND': 'openstack_auth.vault.LocalMemoryTokenVault'},
+        OPENSTACK_TOKEN_VAULT_SESSION_TOKEN=True)
+    def test_token_vaulted_as_json(self):
+        user.set_session_from_user(self.request, self._create_user())
+        token_vault = vault.get_vault()
+        data = token_vault.load(self.token._vault_reference)
+        state = utils.decode_session_data(data)
+        self.assertEqual(self.token.id, state['id'])
+        # Data in another format, e.g. pickled, is not loaded.
+        reference = token_vault.store(pickle.dumps({'id': 'x'}), 60)
+        self.assertIsNone(user._load_token_from_vault(reference))
+
+
+class SessionSizeTestCase(test.TestCase):
+
+    def setUp(self):
+        super(SessionSizeTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        self.session = cache_session.SessionStore()
+        utils.SESSION_SIZES.clear()
+        self.addCleanup(utils.SESSION_SIZES.clear)
+
+    def test_size_histogram(self):
+        histogram = utils.SizeHistogram([10, 100])
+        for size in (5, 10, 50, 500):
+            histogram.observe('key', size)
+        self.assertEqual({'key': {'count': 4, 'sum': 565,
+                                  'buckets': [(10, 2), (100, 1),
+                                              (None, 1)]}},
+                         histogram.snapshot())
+
+    def test_measuring_disabled(self):
+        self.assertIsNone(utils.measure_session_value('key', 'value'))
+        utils.set_session_value(self.session, 'key', 'value')
+        self.assertEqual({}, utils.SESSION_SIZES.snapshot())
+
+    @override_settings(OPENSTACK_SESSION_SIZE_METRICS=True)
+    def test_session_sizes(self):
+        token = user.Token(self.data.scoped_access_info)
+        utils.set_session_value(self.session, 'token', token)
+        utils.set_session_value(self.session, 'unscoped_token', 'a' * 300)
+        sizes = utils.SESSION_SIZES.snapshot()
+        self.assertEqual(1, sizes['token']['count'])
+        self.assertEqual(
+            len(pickle.dumps({'token': token}, pickle.HIGHEST_PROTOCOL)),
+            sizes['token']['sum'])
+        self.assertEqual([0, 1], [count for __, count
+                                  in sizes['unscoped_token']['buckets'][:2]])
+
+    @override_settings(OPENSTACK_SESSION_SIZE_BUDGET=100)
+    def test_session_size_budget(self):
+        with mock.patch.object(utils.LOG, 'warning') as warning:
+            utils.measure_session_value('small', 'a')
+            self.assertFalse(warning.called)
+            size = utils.measure_session_value('large', 'a' * 200)
+        self.assertGreater(size, 200)
+        self.assertEqual(1, warning.call_count)
+
+    def test_stored_catalog_is_filtered(self):
+        token = user.Token(self.data.scoped_access_info)
+        self.assertEqual({'identity', 'compute'},
+                         {service['type'] for service in token.serviceCatalog})
+        with override_settings(OPENSTACK_CATALOG_ALLOWLIST={'image': None}):
+            loaded = pickle.loads(pickle.dumps(token))
+            domain_token = pickle.loads(pickle.dumps(
+                user.SessionAccessInfo(self.data.domain_scoped_access_info)))
+        # The identity service is always kept.
+        self.assertEqual(['identity'], [service['type'] for service
+                                        in loaded.serviceCatalog])
+        catalog = domain_token.service_catalog.catalog
+        self.assertEqual(['identity'],
+                         [service['type'] for service in catalog])
+        self.assertEqual(2, len(self.data.domain_scoped_access_info.
+                                service_catalog.catalog))
+
+
+class LazyUserTestCase(test.TestCase):
+
+    def setUp(self):
+        super(LazyUserTestCase, self).setUp()
+        self.data = data_v3.generate_test_data()
+        self.token = user.Token(self.data.scoped_access_info)
+        self.request = http.HttpRequest()
+        self.request.session = {}
+        self.request.session['token'] = self.token
+        self.request.session['user_id'] = self.token.user['id']
+        self.request.session['region_endpoint'] = \
+            settings.OPENSTACK_KEYSTONE_URL
+        self.request.session['services_region'] = None
+        self.request.session[auth.SESSION_KEY] = self.token.user['id']
+        self.request.session[auth.BACKEND_SESSION_KEY] = \
+            'openstack_auth.backend.KeystoneBackend'
+
+    def test_identity_attributes_do_not_build_user(self):
+        with mock.patch.object(user, 'create_user_from_token') as create:
+            lazy_user = utils.get_user(self.request)
+            self.assertTrue(lazy_user)
+            self.assertTrue(lazy_user.is_authenticated())
+            self.assertFalse(lazy_user.is_anonymous())
+            self.assertTrue(lazy_user.is_active)
+            self.assertIs(self.token, lazy_user.token)
+            self.assertEqual(self.token.user['id'], lazy_user.id)
+            self.assertEqual(self.data.project_one.id, lazy_user.project_id)
+            self.assertEqual(self.token.roles, lazy_user.roles)
+            self.assertEqual(settings.OPENSTACK_KEYSTONE_URL,
+                             lazy_user.endpoint)
+        self.assertFalse(create.called)
+
+    def test_policy_check_does_not_build_user(self):
+        with mock.patch.object(user, 'create_user_from_token') as create:
+            for __ in range(2):
+                self.assertFalse(policy.check(
+                    (("identity", "admin_required"),), self.request))
+            lazy_user = utils.get_user(self.request)
+            self.assertFalse(lazy_user.is_superuser)
+            credentials = policy._user_to_credentials(lazy_user)
+            self.assertIs(credentials,
+                          policy._user_to_credentials(lazy_user))
+        self.assertFalse(create.called)
+
+    def test_built_user_is_delegated_to(self):
+        lazy_user = utils.get_user(self.request)
+        lazy_user._setup()
+        with mock.patch.object(user.User, 'is_superuser',
+                               new_callable=mock.PropertyMock,
+                               return_value=True):
+            self.assertTrue(lazy_user.is_superuser)
+        policy._user_to_credentials(lazy_user)
+        self.assertIn('_credentials', lazy_user._wrapped.__dict__)
+
+    def test_catalog_access_builds_user(self):
+        lazy_user = utils.get_user(self.request)
+        self.assertIsInstance(lazy_user, user.User)
+        self.assertEqual('RegionOne', lazy_user.services_region)
+        self.assertEqual(['RegionOne', 'RegionTwo'],
+                         lazy_user.available_services_regions)
+        self.assertTrue(lazy_user.has_perm('openstack.services.identity'))
+        self.assertEqual(self.data.project_one.id, lazy_user.project_id)
+
+    def test_other_user_id_is_anonymous(self):
+        self.request.session[auth.SESSION_KEY] = 'other'
+        self.assertIsInstance(utils.get_user(self.request),
+                              auth_models.AnonymousUser)
+
 
 class UserTestCase(test.TestCase):
 
@@ -1455,6 +2917,30 @@ class UserTestCase(test.TestCase):
                         self.data.domain_scoped_access_info.auth_token))
         self.assertFalse(created_token._is_pki_token(None))
 
+    def test_pki_token_hash_is_cached(self):
+        user._TOKEN_HASH_CACHE.clear()
+        self.addCleanup(user._TOKEN_HASH_CACHE.clear)
+        auth_ref = self.data.domain_scoped_access_info
+        token = user.Token(auth_ref)
+        self.assertEqual(
+            hashlib.md5(auth_ref.auth_token.encode('utf-8')).hexdigest(),
+            token.id)
+        with mock.patch.object(user.hashlib, 'new') as new:
+            self.assertEqual(token.id, user.Token(auth_ref).id)
+        self.assertFalse(new.called)
+        with self.settings(OPENSTACK_TOKEN_HASH_ALGORITHM='sha256'):
+            self.assertEqual(
+                hashlib.sha256(
+                    auth_ref.auth_token.encode('utf-8')).hexdigest(),
+                user.Token(auth_ref).id)
+
+    def test_is_pki_token(self):
+        token = user.Token(self.data.domain_scoped_access_info)
+        self.assertTrue(token._is_pki_token('MIIxyz'))
+        self.assertTrue(token._is_pki_token('PKIZ_xyz'))
+        self.assertFalse(token._is_pki_token(uuid.uuid4().hex))
+        self.assertFalse(token._is_pki_token(''))
+
 
 class BehindProxyTestCase(test.TestCase):
 
@@ -11,39 +11,148 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import hashlib
 import logging
+import zlib
 
 import django
 from django.conf import settings
 from django.contrib.auth import models
 from django.db import models as db_models
+from django.utils import dateparse
 from django.utils import deprecation
+from django.utils import functional
 from keystoneauth1 import exceptions as keystone_exceptions
 from keystoneclient.common import cms as keystone_cms
 import six
 
 from openstack_auth import utils
+from openstack_auth import vault
 
 
 LOG = logging.getLogger(__name__)
 _TOKEN_HASH_ENABLED = getattr(settings, 'OPENSTACK_TOKEN_HASH_ENABLED', True)
+# The prefixes checked by keystone_cms.is_asn1_token and is_pkiz.
+_PKI_TOKEN_PREFIXES = (keystone_cms.PKI_ASN1_PREFIX, keystone_cms.PKIZ_PREFIX)
+
+# Hashes of PKI tokens, by hash algorithm and token. The same tokens are
+# hashed again on every project switch and policy check.
+_TOKEN_HASH_CACHE = utils.LRUCache(
+    getattr(settings, 'OPENSTACK_TOKEN_HASH_CACHE_SIZE', 256))
+
+
+def _hash_token(token):
+    algorithm = getattr(settings, 'OPENSTACK_TOKEN_HASH_ALGORITHM', 'md5')
+    key = (algorithm, token)
+    token_hash = _TOKEN_HASH_CACHE.get(key)
+    if token_hash is None:
+        hasher = hashlib.new(algorithm)
+        hasher.update(token.encode('utf-8'))
+        token_hash = hasher.hexdigest()
+        _TOKEN_HASH_CACHE.set(key, token_hash)
+    return token_hash
 
 
 def set_session_from_user(request, user):
-    request.session['token'] = user.token
-    request.session['user_id'] = user.id
-    request.session['region_endpoint'] = user.endpoint
-    request.session['services_region'] = user.services_region
+    # Only the changed keys are written, as any write makes the whole
+    # session be saved again.
+    token = user.token
+    if getattr(settings, 'OPENSTACK_TOKEN_VAULT_SESSION_TOKEN', False):
+        token = _store_token_in_vault(token)
+    previous_token = request.session.get('token')
+    if utils.set_session_value(request.session, 'token', token):
+        delete_token_from_vault(previous_token)
+    utils.set_session_value(request.session, 'user_id', user.id)
+    utils.set_session_value(request.session, 'region_endpoint', user.endpoint)
+    utils.set_session_value(request.session, 'services_region',
+                            user.services_region)
     # Update the user object cached in the request
     request._cached_user = user
     request.user = user
 
 
+def _store_token_in_vault(token):
+    """Stores a token in the token vault, unless it is already there.
+
+    The session then only holds the vault reference of the token, so the
+    light keys of the session, such as the services region, are saved
+    without the token.
+    """
+    token_vault = vault.get_vault()
+    if token_vault is None or getattr(token, '_vault_reference', None):
+        return token
+    try:
+        data = utils.encode_session_data(
+            _token_state_to_json(token.__getstate__()))
+    except TypeError:
+        LOG.warning('The token holds values that cannot be stored in the '
+                    'token vault, it is kept in the session.')
+        return token
+    timeout = utils.get_token_life(token.expires)
+    if timeout is None:
+        timeout = getattr(settings, 'SESSION_TIMEOUT', 3600)
+    token._vault_reference = token_vault.store(data, timeout)
+    return token
+
+
+def _load_token_from_vault(reference):
+    """Loads a token stored by :func:`_store_token_in_vault`.
+
+    Returns ``None`` if the token is no longer in the vault.
+    """
+    token_vault = vault.get_vault()
+    data = token_vault and token_vault.load(reference)
+    if not data:
+        return None
+    try:
+        state = _token_state_from_json(utils.decode_session_data(data))
+    except (ValueError, zlib.error):
+        LOG.warning('Ignoring a token in an unknown format in the token '
+                    'vault.')
+        return None
+    token = Token.__new__(Token)
+    token.__setstate__(state)
+    token._vault_reference = reference
+    return token
+
+
+def _token_state_to_json(state):
+    """Returns the state of a token as JSON serializable values."""
+    state = dict(state)
+    if state.get('_expires') is not None:
+        state['_expires'] = state['_expires'].isoformat()
+    if '_encoded_catalog' in state:
+        state['_encoded_catalog'] = base64.b64encode(
+            state['_encoded_catalog']).decode('ascii')
+    return state
+
+
+def _token_state_from_json(state):
+    """Returns the token state saved by :func:`_token_state_to_json`."""
+    if state.get('_expires') is not None:
+        state['_expires'] = dateparse.parse_datetime(state['_expires'])
+    if '_encoded_catalog' in state:
+        state['_encoded_catalog'] = base64.b64decode(
+            state['_encoded_catalog'])
+    for key, fields in Token._RECORDS:
+        if isinstance(state.get(key), list):
+            state[key] = tuple(state[key])
+    return state
+
+
+def delete_token_from_vault(token):
+    """Deletes a token from the token vault, if it is stored there."""
+    reference = getattr(token, '_vault_reference', None)
+    token_vault = vault.get_vault()
+    if reference and token_vault is not None:
+        token_vault.delete(reference)
+
+
 def create_user_from_token(request, token, endpoint, services_region=None):
     # if the region is provided, use that, otherwise use the preferred region
     svc_region = services_region or \
-        utils.default_services_region(token.serviceCatalog, request)
+        utils.default_services_region(token.catalog_index, request)
     return User(id=token.user['id'],
                 token=token,
                 user=token.user['name'],
@@ -65,6 +174,215 @@ def create_user_from_token(request, token, endpoint, services_region=None):
                                        request.session.get('unscoped_token')))
 
 
+# User attributes that a LazyUser serves from the token, without building
+# the full User.
+_LAZY_USER_ATTRIBUTES = {
+    'id': lambda token: token.user['id'],
+    'pk': lambda token: token.user['id'],
+    'keystone_user_id': lambda token: token.user['id'],
+    'username': lambda token: token.user['name'],
+    'user_domain_id': lambda token: token.user_domain_id,
+    'user_domain_name': lambda token: getattr(token, 'user_domain_name',
+                                              None),
+    'project_id': lambda token: token.project['id'],
+    'tenant_id': lambda token: token.project['id'],
+    'project_name': lambda token: token.project['name'],
+    'tenant_name': lambda token: token.project['name'],
+    'domain_id': lambda token: token.domain['id'],
+    'domain_name': lambda token: token.domain['name'],
+    'roles': lambda token: token.roles,
+    'is_federated': lambda token: getattr(token, 'is_federated', False),
+    'enabled': lambda token: True,
+}
+
+
+def _has_admin_role(roles):
+    admin_roles = utils.get_admin_roles()
+    user_roles = {role['name'].lower() for role in roles}
+    return not admin_roles.isdisjoint(user_roles)
+
+
+class LazyUser(functional.SimpleLazyObject):
+    """Proxy to the :class:`User` of a request, built on first real use.
+
+    Building a User from the session data indexes the service catalog and
+    computes the default services region, which most requests that only
+    check whether the user is authenticated never need. The proxy serves
+    the token and the plain identity attributes (ids, names, roles) from
+    the session's token, and only creates the full User when anything
+    else, such as the catalog, the region or the permissions, is accessed.
+    Policy checks only use the identity attributes, so they do not build
+    the user either.
+    """
+
+    # The credentials memoized by the policy checks, kept on the proxy.
+    _PROXY_ATTRIBUTES = ('_credentials', '_domain_credentials')
+
+    def __init__(self, request, token, endpoint, services_region=None):
+        def create_user():
+            return create_user_from_token(request, token, endpoint,
+                                          services_region)
+
+        super(LazyUser, self).__init__(create_user)
+        # Set through __dict__ as LazyObject.__setattr__ would build the
+        # user.
+        self.__dict__['_token'] = token
+        self.__dict__['_endpoint'] = endpoint
+
+    def __getattr__(self, name):
+        if self._wrapped is functional.empty:
+            if name == 'token':
+                return self._token
+            if name == 'endpoint':
+                return self._endpoint
+            attribute = _LAZY_USER_ATTRIBUTES.get(name)
+            if attribute is not None:
+                return attribute(self._token)
+            if name in self._PROXY_ATTRIBUTES:
+                raise AttributeError(name)
+        return super(LazyUser, self).__getattr__(name)
+
+    def __setattr__(self, name, value):
+        if (name in self._PROXY_ATTRIBUTES and
+                self._wrapped is functional.empty):
+            self.__dict__[name] = value
+        else:
+            super(LazyUser, self).__setattr__(name, value)
+
+    def is_token_expired(self, margin=None):
+        """See :meth:`User.is_token_expired`."""
+        if self._wrapped is not functional.empty:
+            return self._wrapped.is_token_expired(margin)
+        if self._token is None:
+            return None
+        return not utils.is_token_valid(self._token, margin)
+
+    if django.VERSION >= (1, 10):
+        @property
+        def is_authenticated(self):
+            """See :attr:`User.is_authenticated`."""
+            if self._wrapped is not functional.empty:
+                return self._wrapped.is_authenticated
+            return deprecation.CallableBool(self.is_token_expired() is False)
+
+        @property
+        def is_anonymous(self):
+            """See :attr:`User.is_anonymous`."""
+            if self._wrapped is not functional.empty:
+                return self._wrapped.is_anonymous
+            return deprecation.CallableBool(not self.is_authenticated)
+    else:
+        def is_authenticated(self, margin=None):
+            """See :meth:`User.is_authenticated`."""
+            if self._wrapped is not functional.empty:
+                return self._wrapped.is_authenticated(margin)
+            return self.is_token_expired(margin) is False
+
+        def is_anonymous(self, margin=None):
+            """See :meth:`User.is_anonymous`."""
+            if self._wrapped is not functional.empty:
+                return self._wrapped.is_anonymous(margin)
+            return not self.is_authenticated(margin)
+
+    @property
+    def is_active(self):
+        """See :attr:`User.is_active`."""
+        if self._wrapped is not functional.empty:
+            return self._wrapped.is_active
+        return True
+
+    @property
+    def is_superuser(self):
+        """See :attr:`User.is_superuser`."""
+        if self._wrapped is not functional.empty:
+            return self._wrapped.is_superuser
+        return _has_admin_role(self._token.roles)
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__
+
+
+class SessionAccessInfo(functional.SimpleLazyObject):
+    """An AccessInfo kept in the session in the encoded session format.
+
+    The proxy behaves as the wrapped ``AccessInfo``. Once loaded from the
+    session, the access info is only decoded when it is used, and saving the
+    session again reuses the encoded data::
+
+        request.session['domain_token'] = SessionAccessInfo(domain_auth_ref)
+    """
+
+    def __init__(self, auth_ref=None, encoded=None):
+        if auth_ref is not None:
+            encoded = utils.encode_access_info(auth_ref)
+        super(SessionAccessInfo, self).__init__(
+            lambda: utils.decode_access_info(encoded))
+        self.__dict__['_encoded'] = encoded
+        if auth_ref is not None:
+            self._wrapped = auth_ref
+
+    def __reduce_ex__(self, protocol):
+        return (type(self), (None, self._encoded))
+
+    def __reduce__(self):
+        return self.__reduce_ex__(None)
+
+
+class VaultAccessInfo(functional.SimpleLazyObject):
+    """An AccessInfo kept in the token vault, referenced from the session.
+
+    The session only holds the short signed reference returned by the
+    vault configured with OPENSTACK_TOKEN_VAULT, so the access info also
+    fits cookie backed sessions. It is loaded from the vault on first use,
+    and evaluates to ``None`` once it is gone from the vault.
+    """
+
+    def __init__(self, auth_ref=None, reference=None):
+        if auth_ref is not None:
+            timeout = utils.get_token_life(auth_ref.expires)
+            if timeout is None:
+                timeout = getattr(settings, 'SESSION_TIMEOUT', 3600)
+            reference = vault.get_vault().store(
+                utils.encode_access_info(auth_ref), timeout)
+
+        def load():
+            token_vault = vault.get_vault()
+            encoded = token_vault and token_vault.load(reference)
+            if not encoded:
+                return None
+            return utils.decode_access_info(encoded)
+
+        super(VaultAccessInfo, self).__init__(load)
+        self.__dict__['_reference'] = reference
+        if auth_ref is not None:
+            self._wrapped = auth_ref
+
+    def delete(self):
+        """Deletes the access info from the vault."""
+        token_vault = vault.get_vault()
+        if token_vault is not None:
+            token_vault.delete(self._reference)
+
+    def __reduce_ex__(self, protocol):
+        return (type(self), (None, self._reference))
+
+    def __reduce__(self):
+        return self.__reduce_ex__(None)
+
+
+def _token_record(fields, *values):
+    """Returns a token record, a dict with its string values interned.
+
+    Tokens of every session keep one record per user, project, domain and
+    role. Interned, the names and ids repeated across the sessions of the
+    process are shared, while the records stay plain dicts for Horizon.
+    """
+    return dict((field, utils.intern_string(value)) for field, value
+                in six.moves.zip_longest(fields, values))
+
+
 class Token(object):
     """Encapsulates the AccessInfo object from keystoneclient.
 
@@ -74,12 +392,16 @@ class Token(object):
     Added for maintaining backward compatibility with horizon that expects
     Token object in the user object.
     """
+
+    # The fields of the records, kept as tuples of values in the session.
+    _RECORDS = (('user', ('id', 'name')),
+                ('project', ('id', 'name', 'is_admin_project', 'domain_id')),
+                ('domain', ('id', 'name')))
+
     def __init__(self, auth_ref, unscoped_token=None):
         # User-related attributes
-        user = {}
-        user['id'] = auth_ref.user_id
-        user['name'] = auth_ref.username
-        self.user = user
+        self.user = _token_record(('id', 'name'), auth_ref.user_id,
+                                  auth_ref.username)
         self.user_domain_id = auth_ref.user_domain_id
         self.user_domain_name = auth_ref.user_domain_name
 
@@ -87,45 +409,220 @@ class Token(object):
         self.id = auth_ref.auth_token
         self.unscoped_token = unscoped_token
         if _TOKEN_HASH_ENABLED and self._is_pki_token(self.id):
-            algorithm = getattr(settings, 'OPENSTACK_TOKEN_HASH_ALGORITHM',
-                                'md5')
-            hasher = hashlib.new(algorithm)
-            hasher.update(self.id.encode('utf-8'))
-            self.id = hasher.hexdigest()
+            self.id = _hash_token(self.id)
             # Only hash unscoped token if needed
             if self._is_pki_token(self.unscoped_token):
-                hasher = hashlib.new(algorithm)
-                hasher.update(self.unscoped_token.encode('utf-8'))
-                self.unscoped_token = hasher.hexdigest()
+                self.unscoped_token = _hash_token(self.unscoped_token)
         self.expires = auth_ref.expires
 
         # Project-related attributes
-        project = {}
-        project['id'] = auth_ref.project_id
-        project['name'] = auth_ref.project_name
-        project['is_admin_project'] = getattr(auth_ref, 'is_admin_project',
-                                              False)
-        project['domain_id'] = getattr(auth_ref, 'project_domain_id', None)
-        self.project = project
+        self.project = _token_record(
+            ('id', 'name', 'is_admin_project', 'domain_id'),
+            auth_ref.project_id,
+            auth_ref.project_name,
+            getattr(auth_ref, 'is_admin_project', False),
+            getattr(auth_ref, 'project_domain_id', None))
         self.tenant = self.project
 
         # Domain-related attributes
-        domain = {}
-        domain['id'] = auth_ref.domain_id
-        domain['name'] = auth_ref.domain_name
-        self.domain = domain
+        self.domain = _token_record(('id', 'name'), auth_ref.domain_id,
+                                    auth_ref.domain_name)
 
         # Federation-related attributes
         self.is_federated = auth_ref.is_federated
-        self.roles = [{'name': role} for role in auth_ref.role_names]
-        self.serviceCatalog = auth_ref.service_catalog.catalog
+        self.roles = [_token_record(('name',), role)
+                      for role in auth_ref.role_names]
+        self.serviceCatalog = utils.intern_catalog(
+            utils.filter_catalog(auth_ref.service_catalog.catalog))
+        catalog_hash = utils.store_catalog(self.serviceCatalog, self.expires)
+        if catalog_hash is not None:
+            self._catalog_hash = catalog_hash
+
+    @property
+    def expires(self):
+        """The expiration datetime of the token."""
+        return self._expires
+
+    @expires.setter
+    def expires(self, expires):
+        self._expires = expires
+        # Precomputed for utils.is_token_valid, which is called several
+        # times per request.
+        self.expires_epoch = utils.get_expiry_timestamp(expires)
+
+    @property
+    def serviceCatalog(self):
+        """The service catalog, decoded from the session on first use.
+
+        Empty if the catalog is gone from the catalog store.
+        """
+        catalog = self._load_service_catalog()
+        return [] if catalog is None else catalog
+
+    @property
+    def is_catalog_evicted(self):
+        """Whether the service catalog is gone from the catalog store.
+
+        Only tokens referencing their catalog by hash are checked, and the
+        catalog is not decoded.
+        """
+        return ('_service_catalog' not in self.__dict__ and
+                '_catalog_hash' in self.__dict__ and
+                not utils.has_stored_catalog(self._catalog_hash))
+
+    def fetch_service_catalog(self, auth_url):
+        """Fetches the service catalog from Keystone and stores it again.
+
+        Returns ``False`` if the catalog could not be fetched.
+        """
+        try:
+            catalog = utils.fetch_catalog(auth_url, self)
+        except Exception:
+            LOG.exception('Failed to fetch the service catalog of the '
+                          'token from Keystone.')
+            return False
+        catalog = utils.intern_catalog(utils.filter_catalog(catalog))
+        catalog_hash = utils.store_catalog(catalog, self.expires)
+        if catalog_hash != self.__dict__.get('_catalog_hash'):
+            # The token stored in the token vault references another
+            # catalog, it has to be stored again.
+            self.__dict__.pop('_vault_reference', None)
+        self.serviceCatalog = catalog
+        if catalog_hash is not None:
+            self._catalog_hash = catalog_hash
+        return True
+
+    def _load_service_catalog(self):
+        if '_service_catalog' not in self.__dict__:
+            if '_catalog_hash' in self.__dict__:
+                catalog = utils.load_catalog(self._catalog_hash)
+                if catalog is None:
+                    return None
+            else:
+                catalog = utils.intern_catalog(utils.decode_session_data(
+                    self.__dict__.pop('_encoded_catalog')))
+            self._service_catalog = catalog
+        return self._service_catalog
+
+    @serviceCatalog.setter
+    def serviceCatalog(self, catalog):
+        self.__dict__.pop('_encoded_catalog', None)
+        self.__dict__.pop('_catalog_hash', None)
+        self._service_catalog = catalog
+
+    def __reduce_ex__(self, protocol):
+        reference = self.__dict__.get('_vault_reference')
+        if reference:
+            # The token is kept in the token vault.
+            return (_load_token_from_vault, (reference,))
+        return super(Token, self).__reduce_ex__(protocol)
+
+    def __getstate__(self):
+        # The catalog index is derived data, keep it out of the session. The
+        # catalog is the bulk of the token: it is only referenced by hash
+        # when it is in the catalog store, and otherwise stored encoded. It
+        # is only decoded when the loaded token's catalog is used.
+        state = self.__dict__.copy()
+        state.pop('_catalog_index', None)
+        state.pop('_vault_reference', None)
+        if '_catalog_hash' in state:
+            state.pop('_service_catalog', None)
+        elif '_encoded_catalog' not in state:
+            state['_encoded_catalog'] = utils.encode_session_data(
+                utils.filter_catalog(state.pop('_service_catalog')))
+        # The records are stored as plain values, and the tenant alias is
+        # restored on load.
+        if state.get('tenant') is state.get('project'):
+            state.pop('tenant', None)
+        for key, fields in self._RECORDS:
+            record = state.get(key)
+            if isinstance(record, dict) and set(record) == set(fields):
+                state[key] = tuple(record[field] for field in fields)
+        roles = state.get('roles', ())
+        if all(isinstance(role, dict) and list(role) == ['name']
+               for role in roles):
+            state['roles'] = [role['name'] for role in roles]
+        state['_version'] = utils.SESSION_DATA_VERSION
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        if state.pop('_version', None) is None:
+            # A token pickled by an earlier release, holding the catalog
+            # in its attributes.
+            state['_service_catalog'] = state.pop('serviceCatalog')
+            state.pop('_catalog_index', None)
+            if 'expires' in state:
+                state['_expires'] = state.pop('expires')
+                state['expires_epoch'] = utils.get_expiry_timestamp(
+                    state['_expires'])
+        alias = state.get('tenant', state.get('project')) is \
+            state.get('project')
+        for key, fields in self._RECORDS:
+            if isinstance(state.get(key), tuple):
+                state[key] = _token_record(fields, *state[key])
+        if alias:
+            state['tenant'] = state.get('project')
+        state['roles'] = [_token_record(('name',), role)
+                          if isinstance(role, six.string_types) else role
+                          for role in state.get('roles', ())]
+        self.__dict__.update(state)
+
+    @property
+    def catalog_index(self):
+        """Index of the service catalog, built on first use."""
+        index = getattr(self, '_catalog_index', None)
+        if index is None or index.catalog is not self.serviceCatalog:
+            index = utils.ServiceCatalogIndex(self.serviceCatalog)
+            self._catalog_index = index
+        return index
 
     def _is_pki_token(self, token):
         """Determines if this is a pki-based token (pki or pkiz)"""
         if token is None:
             return False
-        return (keystone_cms.is_ans1_token(token)
-                or keystone_cms.is_pkiz(token))
+        return token.startswith(_PKI_TOKEN_PREFIXES)
+
+
+class PermissionChecker(object):
+    """A permission list compiled for repeated checks.
+
+    The permission list has the format accepted by :meth:`User.has_perms`:
+    the permission strings are all required, and for every tuple one of its
+    permissions is required. Compiling the list once, e.g. in a panel or
+    table decorator, turns each later check into set operations against the
+    user's permission set instead of a backend lookup per permission::
+
+        checker = PermissionChecker(('openstack.roles.admin',
+                                     ('openstack.services.compute',
+                                      'openstack.services.volume')))
+        checker(request.user)
+    """
+
+    def __init__(self, perm_list):
+        required = set()
+        any_of = []
+        for perm in perm_list or ():
+            if isinstance(perm, six.string_types):
+                required.add(perm)
+            elif perm:
+                any_of.append(frozenset(perm))
+        self.required = frozenset(required)
+        self.any_of = tuple(any_of)
+
+    def __call__(self, user, obj=None):
+        """Returns True if the user has the compiled permissions."""
+        if not self.required and not self.any_of:
+            return True
+        if not user.is_active:
+            return False
+        return self.check(user.get_all_permissions(obj))
+
+    def check(self, permissions):
+        """Returns True if the permission set satisfies the compiled list."""
+        return (self.required.issubset(permissions) and
+                all(not perms.isdisjoint(permissions)
+                    for perms in self.any_of))
 
 
 class User(models.AbstractBaseUser, models.AnonymousUser):
@@ -219,9 +716,10 @@ class User(models.AbstractBaseUser, models.AnonymousUser):
         self.project_id = project_id or tenant_id
         self.project_name = project_name or tenant_name
         self.service_catalog = service_catalog
-        self._services_region = (
+        self._catalog_index = None
+        self._services_region = utils.intern_string(
             services_region
-            or utils.default_services_region(service_catalog)
+            or utils.default_services_region(self.catalog_index)
         )
         self.roles = roles or []
         self.endpoint = endpoint
@@ -319,9 +817,7 @@ class User(models.AbstractBaseUser, models.AnonymousUser):
 
         Returns ``True`` or ``False``.
         """
-        admin_roles = utils.get_admin_roles()
-        user_roles = {role['name'].lower() for role in self.roles}
-        return not admin_roles.isdisjoint(user_roles)
+        return _has_admin_role(self.roles)
 
     @property
     def authorized_tenants(self):
@@ -333,6 +829,7 @@ class User(models.AbstractBaseUser, models.AnonymousUser):
                     user_id=self.id,
                     auth_url=endpoint,
                     token=self.unscoped_token,
+                    expires=self.token.expires,
                     is_federated=self.is_federated)
             except (keystone_exceptions.ClientException,
                     keystone_exceptions.AuthorizationFailure):
@@ -349,22 +846,30 @@ class User(models.AbstractBaseUser, models.AnonymousUser):
 
     @services_region.setter
     def services_region(self, region):
-        self._services_region = region
+        self._services_region = utils.intern_string(region)
+
+    @property
+    def catalog_index(self):
+        """Returns the index of the user's service catalog.
+
+        The index of the token is shared when the user carries the token's
+        service catalog.
+        """
+        index = self._catalog_index
+        if index is None or index.catalog is not self.service_catalog:
+            token_catalog = getattr(self.token, 'serviceCatalog', None)
+            if (token_catalog is not None and
+                    token_catalog is self.service_catalog):
+                index = self.token.catalog_index
+            else:
+                index = utils.ServiceCatalogIndex(self.service_catalog)
+            self._catalog_index = index
+        return index
 
     @property
     def available_services_regions(self):
         """Returns list of unique region name values in service catalog."""
-        regions = []
-        if self.service_catalog:
-            for service in self.service_catalog:
-                service_type = service.get('type')
-                if service_type is None or service_type == 'identity':
-                    continue
-                for endpoint in service.get('endpoints', []):
-                    region = utils.get_endpoint_region(endpoint)
-                    if region not in regions:
-                        regions.append(region)
-        return regions
+        return list(self.catalog_index.regions)
 
     def save(*args, **kwargs):
         # Presume we can't write to Keystone.
@@ -409,7 +914,11 @@ class User(models.AbstractBaseUser, models.AnonymousUser):
         Tuples in the list will possess the required permissions if
         the user has a permissions matching one of the elements of
         that tuple
+
+        ``perm_list`` can also be a :class:`PermissionChecker`.
         """
+        if isinstance(perm_list, PermissionChecker):
+            return perm_list(self, obj)
         # If there are no permissions to check, just return true
         if not perm_list:
             return True
@@ -11,28 +11,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import collections
 import datetime
+import hashlib
+import json
 import logging
+import os
+import pickle
 import re
+import threading
+import time
+import zlib
 
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth import middleware
 from django.contrib.auth import models
+from django.core.cache import caches
+from django.utils.module_loading import import_string  # noqa
 from django.utils import timezone
+from keystoneauth1 import access
 from keystoneauth1.identity import v2 as v2_auth
 from keystoneauth1.identity import v3 as v3_auth
 from keystoneauth1 import session
 from keystoneauth1 import token_endpoint
 from keystoneclient.v2_0 import client as client_v2
+from keystoneclient.v2_0 import tenants
 from keystoneclient.v3 import client as client_v3
+from keystoneclient.v3 import projects as v3_projects
+import requests
+from requests import adapters
+import six
 from six.moves.urllib import parse as urlparse
 
+from openstack_auth import vault
+
 
 LOG = logging.getLogger(__name__)
 
 _TOKEN_TIMEOUT_MARGIN = getattr(settings, 'TOKEN_TIMEOUT_MARGIN', 0)
 
+# Keystone sessions shared by every caller of get_session() in this process,
+# keyed by their connection settings.
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
 """
 We need the request object to get the user, so we'll slightly modify the
 existing django.contrib.auth.get_user method. To do so we update the
@@ -69,6 +93,55 @@ def patch_middleware_get_user():
 """ End Monkey-Patching. """
 
 
+class LRUCache(object):
+    """A thread-safe, size bounded, least recently used cache.
+
+    Hits and misses are counted in the ``hits`` and ``misses`` attributes.
+    A cache with a ``maxsize`` of 0 stores nothing.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # Neither counted nor marked as used.
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert to mark the key as the most recently used.
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 def is_token_valid(token, margin=None):
     """Timezone-aware checking of the auth token's expiration timestamp.
 
@@ -84,18 +157,33 @@ def is_token_valid(token, margin=None):
        A default margin can be set by the TOKEN_TIMEOUT_MARGIN in the
        django settings.
     """
-    expiration = token.expires
+    # Tokens precompute the timestamp of their expiration, other auth refs
+    # have it computed here.
+    expires_epoch = getattr(token, 'expires_epoch', None)
+    if expires_epoch is None:
+        expires_epoch = get_expiry_timestamp(token.expires)
     # In case we get an unparseable expiration timestamp, return False
     # so you can't have a "forever" token just by breaking the expires param.
-    if expiration is None:
+    if expires_epoch is None:
         return False
     if margin is None:
         margin = getattr(settings, 'TOKEN_TIMEOUT_MARGIN', 0)
-    expiration = expiration - datetime.timedelta(seconds=margin)
-    if settings.USE_TZ and timezone.is_naive(expiration):
-        # Presumes that the Keystone is using UTC.
-        expiration = timezone.make_aware(expiration, timezone.utc)
-    return expiration > timezone.now()
+    return expires_epoch - margin > time.time()
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def get_expiry_timestamp(expires):
+    """Returns the POSIX timestamp of an expiration datetime, or ``None``.
+
+    Naive datetimes are presumed to be in UTC, as Keystone uses UTC.
+    """
+    if expires is None:
+        return None
+    if timezone.is_naive(expires):
+        expires = timezone.make_aware(expires, timezone.utc)
+    return (expires - _EPOCH).total_seconds()
 
 
 # From django.contrib.auth.views
@@ -127,13 +215,54 @@ def get_keystone_version():
 
 
 def get_session():
+    """Return the process-wide keystoneauth session.
+
+    The session wraps a pooled ``requests`` session so that logins, project
+    switches and project listings reuse warm connections to Keystone instead
+    of paying a new TCP/TLS handshake on every call. A separate connection
+    pool is kept for each Keystone host, with up to
+    ``OPENSTACK_SESSION_POOL_SIZE`` connections per host. Persistent
+    connections can be turned off with ``OPENSTACK_SESSION_KEEPALIVE``.
+    """
     insecure = getattr(settings, 'OPENSTACK_SSL_NO_VERIFY', False)
     verify = getattr(settings, 'OPENSTACK_SSL_CACERT', True)
 
     if insecure:
         verify = False
 
-    return session.Session(verify=verify)
+    pool_size = getattr(settings, 'OPENSTACK_SESSION_POOL_SIZE', 10)
+    keepalive = getattr(settings, 'OPENSTACK_SESSION_KEEPALIVE', True)
+
+    # Pooled sockets must not be shared with forked worker processes.
+    key = (os.getpid(), verify, pool_size, keepalive)
+    sess = _SESSIONS.get(key)
+    if sess is None:
+        with _SESSIONS_LOCK:
+            sess = _SESSIONS.get(key)
+            if sess is None:
+                sess = session.Session(
+                    verify=verify,
+                    session=_get_requests_session(pool_size, keepalive))
+                _SESSIONS[key] = sess
+    return sess
+
+
+def _get_requests_session(pool_size, keepalive):
+    requests_session = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_maxsize=pool_size)
+    requests_session.mount('http://', adapter)
+    requests_session.mount('https://', adapter)
+    if not keepalive:
+        requests_session.headers['Connection'] = 'close'
+    return requests_session
+
+
+def reset_session():
+    """Close and drop the pooled Keystone sessions of this process."""
+    with _SESSIONS_LOCK:
+        for sess in _SESSIONS.values():
+            sess.session.close()
+        _SESSIONS.clear()
 
 
 def get_keystone_client():
@@ -353,39 +482,359 @@ def get_token_auth_plugin(auth_url, token, project_id=None, domain_name=None):
 
 def get_project_list(*args, **kwargs):
     is_federated = kwargs.get('is_federated', False)
-    sess = kwargs.get('session') or get_session()
-    auth_url, _ = fix_auth_url_version_prefix(kwargs['auth_url'])
-    auth = token_endpoint.Token(auth_url, kwargs['token'])
-    client = get_keystone_client().Client(session=sess, auth=auth)
+    projects = get_cached_project_list(kwargs.get('user_id'),
+                                       kwargs['token'],
+                                       is_federated=is_federated)
+    if projects is None:
+        sess = kwargs.get('session') or get_session()
+        auth_url, _ = fix_auth_url_version_prefix(kwargs['auth_url'])
+        auth = token_endpoint.Token(auth_url, kwargs['token'])
+        client = get_keystone_client().Client(session=sess, auth=auth)
+
+        if get_keystone_version() < 3:
+            projects = client.tenants.list()
+        elif is_federated:
+            projects = client.federation.projects.list()
+        else:
+            projects = client.projects.list(user=kwargs.get('user_id'))
 
-    if get_keystone_version() < 3:
-        projects = client.tenants.list()
-    elif is_federated:
-        projects = client.federation.projects.list()
-    else:
-        projects = client.projects.list(user=kwargs.get('user_id'))
+        cache_project_list(projects, kwargs.get('user_id'), kwargs['token'],
+                           kwargs.get('expires'), is_federated=is_federated)
 
     projects.sort(key=lambda project: project.name.lower())
     return projects
 
 
+def get_cache():
+    """Return the Django cache backing the openstack_auth caches.
+
+    The cache alias is configured by the OPENSTACK_AUTH_CACHE setting.
+    """
+    return caches[getattr(settings, 'OPENSTACK_AUTH_CACHE', 'default')]
+
+
+def get_token_life(expires):
+    """Return the number of seconds until ``expires``, or ``None``."""
+    if expires is None:
+        return None
+    if timezone.is_naive(expires):
+        # Presumes that the Keystone is using UTC.
+        expires = timezone.make_aware(expires, timezone.utc)
+    return int((expires - timezone.now()).total_seconds())
+
+
+def _get_token_cache_key(prefix, token, *args):
+    # Raw tokens never end up in the cache keys.
+    token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    return ':'.join(('openstack_auth', prefix, token_hash) +
+                    tuple(str(arg) for arg in args))
+
+
+def _get_project_list_cache_key(user_id, token, is_federated):
+    return _get_token_cache_key('projects', token, user_id,
+                                int(bool(is_federated)))
+
+
+def get_cached_project_list(user_id, token, is_federated=False):
+    """Return the cached project list of a user and unscoped token.
+
+    Returns ``None`` if the list is not cached.
+    """
+    if not token or not getattr(settings,
+                                'OPENSTACK_PROJECT_LIST_CACHE_TIMEOUT', 300):
+        return None
+    key = _get_project_list_cache_key(user_id, token, is_federated)
+    project_dicts = get_cache().get(key)
+    if project_dicts is None:
+        return None
+    if get_keystone_version() < 3:
+        return [tenants.Tenant(tenants.TenantManager(None), info, loaded=True)
+                for info in project_dicts]
+    return [v3_projects.Project(v3_projects.ProjectManager(None), info,
+                                loaded=True)
+            for info in project_dicts]
+
+
+def cache_project_list(projects, user_id, token, expires,
+                       is_federated=False):
+    """Cache the project list of a user and unscoped token.
+
+    The list is kept for OPENSTACK_PROJECT_LIST_CACHE_TIMEOUT seconds, but
+    never beyond the expiration of the token. Only the project attributes
+    are cached, not the keystoneclient managers the projects belong to.
+    """
+    timeout = getattr(settings, 'OPENSTACK_PROJECT_LIST_CACHE_TIMEOUT', 300)
+    token_life = get_token_life(expires)
+    if not token or token_life is None:
+        return
+    timeout = min(timeout, token_life)
+    if timeout <= 0:
+        return
+    key = _get_project_list_cache_key(user_id, token, is_federated)
+    get_cache().set(key, [project.to_dict() for project in projects],
+                    timeout)
+
+
+def remove_cached_project_list(user_id, token):
+    """Remove the cached project lists of a user and unscoped token."""
+    if token:
+        get_cache().delete_many(
+            [_get_project_list_cache_key(user_id, token, is_federated)
+             for is_federated in (False, True)])
+
+
+def get_cached_scoped_auth_ref(session, unscoped_token, project_id):
+    """Return a project scoped access info cached for the session, or ``None``.
+
+    Access infos obtained with another unscoped token, cached more than
+    OPENSTACK_SCOPED_TOKEN_CACHE_TIMEOUT seconds ago, or that are no longer
+    valid, taking TOKEN_TIMEOUT_MARGIN into account, are never returned.
+    """
+    if not unscoped_token or not getattr(
+            settings, 'OPENSTACK_SCOPED_TOKEN_CACHE_TIMEOUT', 3600):
+        return None
+    entry = session.get('scoped_tokens', {}).get(project_id)
+    if entry is None:
+        return None
+    token_hash, cached_until, reference = entry
+    if (token_hash != _get_unscoped_token_hash(unscoped_token) or
+            cached_until <= time.time()):
+        return None
+    encoded = _get_scoped_token_vault().load(reference)
+    if not encoded:
+        return None
+    auth_ref = decode_access_info(encoded)
+    if not is_token_valid(auth_ref):
+        return None
+    return auth_ref
+
+
+def cache_scoped_auth_ref(session, unscoped_token, auth_ref):
+    """Cache a project scoped access info obtained with an unscoped token.
+
+    The access info is kept in the token vault, or in the cache when no
+    vault is configured, and the session only holds its reference. It is
+    cached for OPENSTACK_SCOPED_TOKEN_CACHE_TIMEOUT seconds but never
+    beyond its own expiration, and only for the
+    OPENSTACK_SCOPED_TOKEN_CACHE_SIZE most recently cached projects.
+    Nothing is cached in cookie backed sessions.
+    """
+    timeout = getattr(settings, 'OPENSTACK_SCOPED_TOKEN_CACHE_TIMEOUT', 3600)
+    token_life = get_token_life(auth_ref.expires)
+    if (not unscoped_token or not auth_ref.project_id or
+            token_life is None or using_cookie_backed_sessions()):
+        return
+    timeout = min(timeout, token_life)
+    if timeout <= 0:
+        return
+    token_vault = _get_scoped_token_vault()
+    entries = dict(session.get('scoped_tokens', {}))
+    replaced = entries.get(auth_ref.project_id)
+    entries[auth_ref.project_id] = (
+        _get_unscoped_token_hash(unscoped_token), time.time() + timeout,
+        token_vault.store(encode_access_info(auth_ref), timeout))
+    size = getattr(settings, 'OPENSTACK_SCOPED_TOKEN_CACHE_SIZE', 5)
+    removed = [entries.pop(project_id) for project_id in
+               sorted(entries, key=lambda p: entries[p][1])[:-size]]
+    if replaced is not None:
+        removed.append(replaced)
+    for __, __, reference in removed:
+        token_vault.delete(reference)
+    set_session_value(session, 'scoped_tokens', entries)
+
+
+def remove_cached_scoped_auth_refs(session):
+    """Remove the project scoped access infos cached for the session."""
+    entries = session.pop('scoped_tokens', None)
+    if entries:
+        token_vault = _get_scoped_token_vault()
+        for __, __, reference in entries.values():
+            token_vault.delete(reference)
+
+
+def _get_scoped_token_vault():
+    return vault.get_vault() or vault.CacheTokenVault()
+
+
+def _get_unscoped_token_hash(unscoped_token):
+    return hashlib.sha256(unscoped_token.encode('utf-8')).hexdigest()
+
+
+# Service catalogs rehydrated from the catalog store, by hash. Tokens
+# referencing the same catalog share the decoded catalog.
+_CATALOG_CACHE = LRUCache(getattr(settings, 'OPENSTACK_CATALOG_CACHE_SIZE',
+                                  100))
+
+
+def _get_catalog_cache_key(catalog_hash):
+    return ':'.join(('openstack_auth', 'catalog', catalog_hash))
+
+
+def store_catalog(catalog, expires):
+    """Store a service catalog in the shared catalog store.
+
+    Users scoped to the same project and region get identical catalogs, so
+    when OPENSTACK_CATALOG_STORE_ENABLED is set a catalog is kept once in
+    the cache, under the hash of its content, and sessions only reference
+    it by hash. The entry is only written when it is missing or would
+    expire before the token it is stored for, and lives as long as that
+    token, or SESSION_TIMEOUT seconds for tokens without an expiration.
+
+    Returns the hash of the catalog, or ``None`` if it was not stored.
+    """
+    if not getattr(settings, 'OPENSTACK_CATALOG_STORE_ENABLED', False):
+        return None
+    token_life = get_token_life(expires)
+    if token_life is None:
+        token_life = getattr(settings, 'SESSION_TIMEOUT', 3600)
+        stored_until = int(time.time()) + token_life
+    else:
+        stored_until = get_expiry_timestamp(expires)
+    if token_life <= 0:
+        return None
+    # Every process rehydrates the same catalog from the store.
+    catalog = filter_catalog(catalog)
+    data = json.dumps(catalog, sort_keys=True, separators=(',', ':'))
+    data = data.encode('utf-8')
+    catalog_hash = hashlib.sha256(data).hexdigest()
+    key = _get_catalog_cache_key(catalog_hash)
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is None or entry[0] < stored_until:
+        cache.set(key, (stored_until, zlib.compress(data)), token_life)
+    _CATALOG_CACHE.set(catalog_hash, catalog)
+    return catalog_hash
+
+
+def load_catalog(catalog_hash):
+    """Return the service catalog stored under ``catalog_hash``.
+
+    Returns ``None`` if it is no longer in the catalog store.
+    """
+    catalog = _CATALOG_CACHE.get(catalog_hash)
+    if catalog is None:
+        entry = get_cache().get(_get_catalog_cache_key(catalog_hash))
+        if entry is None:
+            LOG.warning('The service catalog %s is missing from the catalog '
+                        'store. Check that OPENSTACK_AUTH_CACHE is shared '
+                        'by all the processes and large enough.',
+                        catalog_hash)
+            return None
+        catalog = intern_catalog(decode_session_data(entry[1]))
+        _CATALOG_CACHE.set(catalog_hash, catalog)
+    return catalog
+
+
+def has_stored_catalog(catalog_hash):
+    """Whether the catalog store holds ``catalog_hash``, without decoding it.
+    """
+    if catalog_hash in _CATALOG_CACHE:
+        return True
+    return get_cache().get(_get_catalog_cache_key(catalog_hash)) is not None
+
+
+def fetch_catalog(auth_url, token):
+    """Fetches the service catalog of a token from Keystone.
+
+    The catalog is read from ``/v3/auth/catalog`` with Keystone v3, and from
+    the token obtained by authenticating again with the token with v2.
+    """
+    auth_url, _ = fix_auth_url_version_prefix(auth_url)
+    session = get_session()
+    if get_keystone_version() >= 3:
+        response = session.get(url_path_append(auth_url, '/auth/catalog'),
+                               headers={'X-Auth-Token': token.id},
+                               authenticated=False)
+        return response.json()['catalog']
+    plugin = get_token_auth_plugin(auth_url, token.id,
+                                   project_id=token.project['id'])
+    return plugin.get_access(session).service_catalog.catalog
+
+
+class ServiceCatalogIndex(object):
+    """Lookup structure over a raw Keystone service catalog.
+
+    The catalog is walked once when the index is built. Endpoints can then
+    be looked up by service type, interface and region, and the regions and
+    the services available per region are precomputed.
+
+    .. attribute:: catalog
+
+        The raw service catalog the index was built from.
+
+    .. attribute:: regions
+
+        The unique regions of the non-identity service endpoints, in
+        catalog order.
+
+    .. attribute:: all_regions
+
+        The unique regions of all the endpoints, in catalog order.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.regions = []
+        self.all_regions = []
+        self._endpoints = {}
+        self._services = {}
+        for service in catalog or []:
+            service_type = service.get('type')
+            endpoints = service.get('endpoints', [])
+            if service_type is not None:
+                self._endpoints.setdefault(service_type, []).extend(endpoints)
+            for endpoint in endpoints:
+                region = get_endpoint_region(endpoint)
+                if region not in self.all_regions:
+                    self.all_regions.append(region)
+                if service_type is None:
+                    continue
+                if service_type != 'identity' and region not in self.regions:
+                    self.regions.append(region)
+                self._services.setdefault(region, set()).add(
+                    service_type.lower())
+        self._services = {region: frozenset(services)
+                          for region, services in self._services.items()}
+
+    def get_endpoints(self, service_type, interface=None, region=None):
+        """Returns the endpoints of a service type.
+
+        :param interface: Only return the endpoints of this interface, e.g.
+            ``'public'``. The v2 ``'publicURL'`` form is accepted as well.
+        :param region: Only return the endpoints of this region.
+        """
+        endpoints = self._endpoints.get(service_type, [])
+        if region is not None:
+            endpoints = [endpoint for endpoint in endpoints
+                         if get_endpoint_region(endpoint) == region]
+        if interface is not None:
+            # v3 endpoints have an interface, v2 endpoints an URL for each
+            # interface.
+            interface = interface.replace('URL', '')
+            endpoints = [endpoint for endpoint in endpoints
+                         if endpoint.get('interface') == interface
+                         or '%sURL' % interface in endpoint]
+        return endpoints
+
+    def get_services(self, region):
+        """Returns the lowercased types of the services in a region."""
+        return self._services.get(region, frozenset())
+
+
 def default_services_region(service_catalog, request=None):
     """Returns the first endpoint region for first non-identity service.
 
-    Extracted from the service catalog.
+    Extracted from the service catalog, which can either be given as the raw
+    catalog or as a :class:`ServiceCatalogIndex`.
     """
-    if service_catalog:
-        available_regions = [get_endpoint_region(endpoint) for service
-                             in service_catalog for endpoint
-                             in service.get('endpoints', [])
-                             if (service.get('type') is not None
-                                 and service.get('type') != 'identity')]
+    if not isinstance(service_catalog, ServiceCatalogIndex):
+        service_catalog = ServiceCatalogIndex(service_catalog)
+    if service_catalog.catalog:
+        available_regions = service_catalog.regions
         if not available_regions:
             # this is very likely an incomplete keystone setup
             LOG.warning('No regions could be found excluding identity.')
-            available_regions = [get_endpoint_region(endpoint) for service
-                                 in service_catalog for endpoint
-                                 in service.get('endpoints', [])]
+            available_regions = service_catalog.all_regions
 
             if not available_regions:
                 # if there are no region setup for any service endpoint,
@@ -428,11 +877,227 @@ def get_endpoint_region(endpoint):
     return endpoint.get('region_id') or endpoint.get('region')
 
 
+def set_session_value(session, key, value):
+    """Sets a session value, unless the session already holds it.
+
+    Any write marks the session as modified, which makes the whole session
+    be saved again at the end of the request.
+
+    Returns ``True`` if the value was written.
+    """
+    if key in session:
+        current = session[key]
+        # Values of different types, such as lazy proxies, are not
+        # compared.
+        if current is value or (type(current) is type(value) and
+                                current == value):
+            return False
+    session[key] = value
+    measure_session_value(key, value)
+    return True
+
+
+class SizeHistogram(object):
+    """A thread-safe histogram of sizes, per name.
+
+    A size is counted in the first bucket whose upper bound is greater or
+    equal to it, or in the overflow bucket past the last bound.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, name, size):
+        index = bisect.bisect_left(self.bounds, size)
+        with self._lock:
+            counts = self._counts.setdefault(name,
+                                             [0] * (len(self.bounds) + 1))
+            counts[index] += 1
+            self._sums[name] = self._sums.get(name, 0) + size
+
+    def snapshot(self):
+        """Returns the histograms as a dict of dicts per name.
+
+        Each dict holds the ``count`` and ``sum`` of the sizes, and the
+        ``buckets`` as a list of ``(upper bound, count)`` pairs, where the
+        overflow bucket has a ``None`` bound.
+        """
+        with self._lock:
+            return {name: {'count': sum(counts),
+                           'sum': self._sums[name],
+                           'buckets': list(zip(self.bounds + (None,),
+                                               counts))}
+                    for name, counts in self._counts.items()}
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            self._sums.clear()
+
+
+# Serialized sizes of the session values written by openstack_auth.
+SESSION_SIZES = SizeHistogram(
+    [256 * 2 ** i for i in range(10)])  # 256 bytes to 128 KiB
+
+
+def measure_session_value(key, value):
+    """Records the serialized size of a session value.
+
+    Measuring is enabled by OPENSTACK_SESSION_SIZE_METRICS or by an
+    OPENSTACK_SESSION_SIZE_BUDGET, in bytes, past which a warning is
+    logged. The sizes are recorded in the SESSION_SIZES histogram.
+
+    Returns the size, or ``None`` if measuring is disabled.
+    """
+    budget = getattr(settings, 'OPENSTACK_SESSION_SIZE_BUDGET', None)
+    if not budget and not getattr(settings, 'OPENSTACK_SESSION_SIZE_METRICS',
+                                  False):
+        return None
+    serializer = import_string(getattr(
+        settings, 'SESSION_SERIALIZER',
+        'django.contrib.sessions.serializers.JSONSerializer'))()
+    try:
+        size = len(serializer.dumps({key: value}))
+    except Exception:
+        # Values such as tokens require the pickle serializer.
+        size = len(pickle.dumps({key: value}, pickle.HIGHEST_PROTOCOL))
+    SESSION_SIZES.observe(key, size)
+    if budget and size > budget:
+        LOG.warning('The session value %(key)s takes %(size)d bytes, over '
+                    'the OPENSTACK_SESSION_SIZE_BUDGET of %(budget)d bytes.',
+                    {'key': key, 'size': size, 'budget': budget})
+    return size
+
+
+def filter_catalog(catalog):
+    """Returns the catalog restricted to OPENSTACK_CATALOG_ALLOWLIST.
+
+    The setting maps the service types to keep to the interfaces of their
+    endpoints to keep, or to ``None`` to keep all of them::
+
+        OPENSTACK_CATALOG_ALLOWLIST = {
+            'compute': ['public'],
+            'image': ['public'],
+            'network': None,
+        }
+
+    The identity service is always kept, with all its interfaces unless it
+    is listed. Services left without endpoints are dropped. The catalog is
+    returned unchanged when the setting is not set.
+    """
+    allowlist = getattr(settings, 'OPENSTACK_CATALOG_ALLOWLIST', None)
+    if allowlist is None:
+        return catalog
+    allowlist = dict(allowlist)
+    allowlist.setdefault('identity', None)
+    filtered = []
+    for service in catalog:
+        if service.get('type') not in allowlist:
+            continue
+        interfaces = allowlist[service.get('type')]
+        if interfaces is not None:
+            service = dict(service)
+            service['endpoints'] = _filter_endpoints(
+                service.get('endpoints', []),
+                {interface.replace('URL', '') for interface in interfaces})
+            if not service['endpoints']:
+                continue
+        filtered.append(service)
+    return filtered
+
+
+def _filter_endpoints(endpoints, interfaces):
+    filtered = []
+    for endpoint in endpoints:
+        if 'interface' in endpoint:
+            # v3 endpoints have an interface.
+            if endpoint['interface'] in interfaces:
+                filtered.append(endpoint)
+            continue
+        # v2 endpoints have an URL for each interface.
+        endpoint = {key: value for key, value in endpoint.items()
+                    if not key.endswith('URL') or
+                    key[:-len('URL')] in interfaces}
+        if any(key.endswith('URL') for key in endpoint):
+            filtered.append(endpoint)
+    return filtered
+
+
 def using_cookie_backed_sessions():
     engine = getattr(settings, 'SESSION_ENGINE', '')
     return "signed_cookies" in engine
 
 
+def intern_string(value):
+    """Interns ``value`` if it is a native string.
+
+    Role names and regions repeat in every session of a deployment, interned
+    they are shared by all the loaded sessions of the process.
+    """
+    if isinstance(value, str):
+        return six.moves.intern(value)
+    return value
+
+
+def intern_catalog(catalog):
+    """Interns the service types, names, interfaces and regions of a catalog.
+
+    The catalog is updated in place and returned.
+    """
+    for service in catalog:
+        for key in ('type', 'name'):
+            if key in service:
+                service[key] = intern_string(service[key])
+        for endpoint in service.get('endpoints', ()):
+            for key in ('interface', 'region', 'region_id'):
+                if key in endpoint:
+                    endpoint[key] = intern_string(endpoint[key])
+    return catalog
+
+
+# Version of the encoded auth data that Token and SessionAccessInfo keep in
+# the session. Sessions holding an older version, or the plain pickled
+# objects of earlier releases, are still loaded.
+SESSION_DATA_VERSION = 1
+
+
+def encode_session_data(data):
+    """Encodes JSON serializable auth data compactly for the session."""
+    return zlib.compress(
+        json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_session_data(encoded):
+    """Decodes auth data encoded by :func:`encode_session_data`."""
+    return json.loads(zlib.decompress(encoded).decode('utf-8'))
+
+
+def encode_access_info(auth_ref):
+    """Encodes an AccessInfo compactly, for the session or the vault."""
+    body = auth_ref._data
+    # Filter the catalog, 'catalog' of v3 tokens or 'serviceCatalog' of v2
+    # access infos.
+    for data_key, catalog_key in (('token', 'catalog'),
+                                  ('access', 'serviceCatalog')):
+        data = body.get(data_key)
+        if data and catalog_key in data:
+            data = dict(data)
+            data[catalog_key] = filter_catalog(data[catalog_key])
+            body = dict(body)
+            body[data_key] = data
+    return encode_session_data(
+        {'auth_token': auth_ref.auth_token, 'body': body})
+
+
+def decode_access_info(encoded):
+    """Decodes an AccessInfo encoded by :func:`encode_access_info`."""
+    data = decode_session_data(encoded)
+    return access.create(body=data['body'], auth_token=data['auth_token'])
+
+
 def get_admin_roles():
     """Common function for getting the admin roles from settings
 
@@ -545,7 +1210,8 @@ def store_initial_k2k_session(auth_url, request, scoped_auth_ref,
 
         # We treat the Keystone idp ID as None
         request.session['keystone_provider_id'] = keystone_idp_id
-        request.session['keystone_providers'] = keystone_providers
+        set_session_value(request.session, 'keystone_providers',
+                          keystone_providers)
         request.session['k2k_base_unscoped_token'] =\
             unscoped_auth_ref.auth_token
         request.session['k2k_auth_url'] = auth_url
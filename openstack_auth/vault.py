@@ -0,0 +1,293 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Server side storage for auth data too large for the session. """
+
+import errno
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core import exceptions
+from django.core import signing
+from django.utils import crypto
+from django.utils.module_loading import import_string  # noqa
+
+
+LOG = logging.getLogger(__name__)
+
+_SALT = 'openstack_auth.vault'
+# The length of the hex HMAC-SHA1 signature of the stored data.
+_SIGNATURE_LENGTH = 40
+
+_VAULT = None
+_VAULT_LOCK = threading.Lock()
+
+
+class TokenVault(object):
+    """Base class of the token vaults.
+
+    A vault keeps heavy auth data, such as the domain scoped token, on the
+    server side. The session, which may be a signed cookie, only holds the
+    short signed reference returned by :meth:`store`.
+
+    The stored data is signed with the secret key, and data whose
+    signature does not match is not loaded, whoever can write to the
+    storage of the vault.
+
+    Subclasses implement :meth:`_set`, :meth:`_get` and :meth:`_delete` on
+    the unsigned keys.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def store(self, data, timeout):
+        """Stores ``data`` for ``timeout`` seconds and returns its reference.
+
+        :param data: The bytes to store.
+        :param timeout: The lifetime of the data in seconds.
+        """
+        key = uuid.uuid4().hex
+        self._set(key, self._signature(key, data) + data, timeout)
+        return signing.dumps(key, salt=_SALT)
+
+    def load(self, reference):
+        """Returns the data of a reference, or ``None`` if there is none."""
+        key = self._unsign(reference)
+        if key is None:
+            return None
+        signed = self._get(key)
+        if not signed:
+            return None
+        signature = signed[:_SIGNATURE_LENGTH]
+        data = signed[_SIGNATURE_LENGTH:]
+        if not crypto.constant_time_compare(signature,
+                                            self._signature(key, data)):
+            LOG.warning('Ignoring token vault data with an invalid '
+                        'signature.')
+            return None
+        return data
+
+    def delete(self, reference):
+        """Deletes the data of a reference."""
+        key = self._unsign(reference)
+        if key is not None:
+            self._delete(key)
+
+    def _signature(self, key, data):
+        signature = crypto.salted_hmac(_SALT, key.encode('ascii') + data)
+        return signature.hexdigest().encode('ascii')
+
+    def _unsign(self, reference):
+        try:
+            return signing.loads(reference, salt=_SALT)
+        except signing.BadSignature:
+            LOG.warning('Ignoring a token vault reference with an invalid '
+                        'signature.')
+            return None
+
+    def _set(self, key, data, timeout):
+        raise NotImplementedError()
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _delete(self, key):
+        raise NotImplementedError()
+
+
+class CacheTokenVault(TokenVault):
+    """Token vault backed by a Django cache.
+
+    The ``CACHE`` option names the cache alias to use. It defaults to the
+    OPENSTACK_AUTH_CACHE setting, or to the ``default`` cache.
+    """
+
+    @property
+    def cache(self):
+        alias = self.options.get(
+            'CACHE', getattr(settings, 'OPENSTACK_AUTH_CACHE', 'default'))
+        return caches[alias]
+
+    def _cache_key(self, key):
+        return ':'.join(('openstack_auth', 'vault', key))
+
+    def _set(self, key, data, timeout):
+        self.cache.set(self._cache_key(key), data, timeout)
+
+    def _get(self, key):
+        return self.cache.get(self._cache_key(key))
+
+    def _delete(self, key):
+        self.cache.delete(self._cache_key(key))
+
+
+class LocalMemoryTokenVault(TokenVault):
+    """Token vault kept in the memory of the process.
+
+    It is only suitable for deployments serving every request of a session
+    from a single process, such as development servers.
+    """
+
+    def __init__(self, **options):
+        super(LocalMemoryTokenVault, self).__init__(**options)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _set(self, key, data, timeout):
+        now = time.time()
+        with self._lock:
+            for expired in [k for k, (expires, __) in self._data.items()
+                            if expires <= now]:
+                del self._data[expired]
+            self._data[key] = (now + timeout, data)
+
+    def _get(self, key):
+        with self._lock:
+            expires, data = self._data.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return None
+            return data
+
+    def _delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class FileTokenVault(TokenVault):
+    """Token vault storing each entry in a file.
+
+    The ``PATH`` option is the directory of the files, and it is required.
+    It must be shared by all the processes serving the sessions, owned by
+    their user and only accessible to it (mode 0700). It is created if it
+    does not exist.
+
+    Expired files are removed when they are read, and the whole directory
+    is swept for expired files on store, at most once every
+    ``SWEEP_INTERVAL`` seconds per process (300 by default). The files are
+    dated with their expiration, so a sweep does not read them.
+    """
+
+    _TMP_PREFIX = '.tmp'
+
+    def __init__(self, **options):
+        super(FileTokenVault, self).__init__(**options)
+        if not options.get('PATH'):
+            raise exceptions.ImproperlyConfigured(
+                'The PATH option of the FileTokenVault is required.')
+        self._next_sweep = 0
+
+    @property
+    def path(self):
+        return self.options['PATH']
+
+    def _check_path(self):
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path_stat = os.lstat(self.path)
+        geteuid = getattr(os, 'geteuid', None)
+        if (not stat.S_ISDIR(path_stat.st_mode) or
+                stat.S_IMODE(path_stat.st_mode) != 0o700 or
+                (geteuid is not None and path_stat.st_uid != geteuid())):
+            raise exceptions.ImproperlyConfigured(
+                'The token vault directory %s must be a directory owned by '
+                'the user of the process, with mode 0700.' % self.path)
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key)
+
+    def _set(self, key, data, timeout):
+        self._check_path()
+        self._sweep()
+        expires = int(time.time() + timeout)
+        fd, tmp_path = tempfile.mkstemp(prefix=self._TMP_PREFIX,
+                                        dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(('%d\n' % expires).encode('ascii') + data)
+        os.utime(tmp_path, (expires, expires))
+        # Readers never see a partially written entry.
+        os.rename(tmp_path, self._file_path(key))
+
+    def _sweep(self):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        interval = self.options.get('SWEEP_INTERVAL', 300)
+        self._next_sweep = now + interval
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            try:
+                expires = os.lstat(file_path).st_mtime
+            except OSError:
+                continue
+            if name.startswith(self._TMP_PREFIX):
+                # Left by an interrupted store, unless still being written.
+                expires += interval
+            if expires <= now:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    def _get(self, key):
+        self._check_path()
+        try:
+            with open(self._file_path(key), 'rb') as f:
+                expires, data = f.read().split(b'\n', 1)
+        except (IOError, OSError, ValueError):
+            return None
+        if int(expires) <= time.time():
+            self._delete(key)
+            return None
+        return data
+
+    def _delete(self, key):
+        try:
+            os.remove(self._file_path(key))
+        except OSError:
+            pass
+
+
+def get_vault():
+    """Returns the token vault configured by OPENSTACK_TOKEN_VAULT.
+
+    The setting is a dict holding the dotted path of the vault class under
+    ``BACKEND`` and the options of the vault under ``OPTIONS``::
+
+        OPENSTACK_TOKEN_VAULT = {
+            'BACKEND': 'openstack_auth.vault.CacheTokenVault',
+            'OPTIONS': {'CACHE': 'default'},
+        }
+
+    Returns ``None`` if no vault is configured.
+    """
+    global _VAULT
+    config = getattr(settings, 'OPENSTACK_TOKEN_VAULT', None)
+    if not config:
+        return None
+    with _VAULT_LOCK:
+        if _VAULT is None or _VAULT[0] != config:
+            vault_class = import_string(config['BACKEND'])
+            _VAULT = (config, vault_class(**config.get('OPTIONS', {})))
+        return _VAULT[1]
@@ -171,6 +171,15 @@ def logout(request, login_url=None, **kwargs):
         {'username': request.user.username}
     LOG.info(msg)
 
+    domain_token = request.session.get('domain_token')
+    if type(domain_token) is auth_user.VaultAccessInfo:
+        domain_token.delete()
+    auth_user.delete_token_from_vault(request.session.get('token'))
+    utils.remove_cached_scoped_auth_refs(request.session)
+    utils.remove_cached_project_list(
+        getattr(request.user, 'id', None),
+        request.session.get('unscoped_token'))
+
     """ Securely logs a user out. """
     return django_auth_views.logout_then_login(request, login_url=login_url,
                                                **kwargs)
@@ -188,17 +197,23 @@ def switch(request, tenant_id, redirect_field_name=auth.REDIRECT_FIELD_NAME):
               % (tenant_id, request.user.username))
 
     endpoint, __ = utils.fix_auth_url_version_prefix(request.user.endpoint)
-    session = utils.get_session()
     # Keystone can be configured to prevent exchanging a scoped token for
     # another token. Always use the unscoped token for requesting a
     # scoped token.
     unscoped_token = request.user.unscoped_token
-    auth = utils.get_token_auth_plugin(auth_url=endpoint,
-                                       token=unscoped_token,
-                                       project_id=tenant_id)
+    # Switching back to a recently used project reuses its scoped token.
+    auth_ref = utils.get_cached_scoped_auth_ref(request.session,
+                                                unscoped_token, tenant_id)
 
     try:
-        auth_ref = auth.get_access(session)
+        if auth_ref is None:
+            session = utils.get_session()
+            auth = utils.get_token_auth_plugin(auth_url=endpoint,
+                                               token=unscoped_token,
+                                               project_id=tenant_id)
+            auth_ref = auth.get_access(session)
+            utils.cache_scoped_auth_ref(request.session, unscoped_token,
+                                        auth_ref)
         msg = 'Project switch successful for user "%(username)s".' % \
             {'username': request.user.username}
         LOG.info(msg)
@@ -241,7 +256,8 @@ def switch_region(request, region_name,
     available for the scoped project. Otherwise the region is not switched.
     """
     if region_name in request.user.available_services_regions:
-        request.session['services_region'] = region_name
+        utils.set_session_value(request.session, 'services_region',
+                                region_name)
         LOG.debug('Switching services region to %s for user "%s".'
                   % (region_name, request.user.username))
 
@@ -315,7 +331,8 @@ def switch_keystone_provider(request, keystone_provider=None,
         auth.login(request, request.user)
         auth_user.set_session_from_user(request, request.user)
         request.session['keystone_provider_id'] = keystone_provider
-        request.session['keystone_providers'] = keystone_providers
+        utils.set_session_value(request.session, 'keystone_providers',
+                                keystone_providers)
         request.session['k2k_base_unscoped_token'] = base_token
         request.session['k2k_auth_url'] = k2k_auth_url
         message = (